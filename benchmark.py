@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Offline throughput and latency benchmark of the three UniDM tasks against the mock LLM.
+
+    python benchmark.py --rows 200 --latency 0.05 --latency_dist lognormal --output bench.json
+    python benchmark.py --rows 200 --latency 0.05 --latency_dist lognormal --compare bench.json
+
+Every task runs end to end in its own process on synthetic data, with caches
+and client rate limits off, against `utils/mock_server.py`. Flags the benchmark
+does not know are passed to every `inference.py` run (e.g. --row_workers 8 or
+--rpm 3000 to time the rate limiter too). Results hold rows/sec,
+per-row wall latency percentiles, LLM calls per row and peak RSS per task, and
+the startup time of `inference.py` (import and --dry_run, each in a fresh
+interpreter); with --compare, metrics that regress by more than --tolerance fail the run.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import inference
+from utils.mock_server import LATENCY_DISTS, MockCompletionServer
+
+logger = logging.getLogger(__name__)
+
+TASK_DATASETS = {
+    "entity_resolution": "Amazon-Google",
+    "data_imputation": "Buy",
+    "data_transformation": "benchmark-stackoverflow",
+}
+BRANDS = ["Sony", "Canon", "Apple", "LG", "Samsung", "Griffin", "Nikon", "Bose", "Panasonic", "Logitech"]
+PRODUCTS = ["camera", "case", "headset", "tv", "speaker", "lens", "charger", "cable", "adapter", "monitor"]
+# Metric -> True when higher is better
+COMPARED = {"rows_per_sec": True, "row_p50": False, "row_p95": False, "row_p99": False, "calls_per_row": False, "peak_rss_mb": False}
+STARTUP_COMPARED = {"import_seconds": False, "dry_run_seconds": False}
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Generate args; unknown flags are forwarded to every run."""
+    parser = argparse.ArgumentParser(description="Benchmark UniDM end to end against a mock LLM.")
+    parser.add_argument("--tasks", type=str, nargs="+", choices=list(TASK_DATASETS), default=list(TASK_DATASETS))
+    parser.add_argument("--rows", type=int, help="Test rows per task.", default=100)
+    parser.add_argument("--seed", type=int, help="Seed of the synthetic data and the mock server.", default=0)
+    parser.add_argument("--work_dir", type=str, help="Where data and outputs go (default: a temporary folder).", default=None)
+    parser.add_argument("--latency", type=float, help="Mock seconds per request (mean, or median for lognormal).", default=0.02)
+    parser.add_argument("--latency_dist", type=str, choices=LATENCY_DISTS, default="lognormal")
+    parser.add_argument("--latency_jitter", type=float, help="Uniform jitter in seconds.", default=0.0)
+    parser.add_argument("--latency_sigma", type=float, help="Log-space spread of the lognormal latency.", default=0.5)
+    parser.add_argument("--error_rate", type=float, help="Probability of an injected 429/5xx.", default=0.0)
+    parser.add_argument("--output", type=str, help="JSON file to write the results to.", default=None)
+    parser.add_argument("--compare", type=str, help="Earlier results to compare against.", default=None)
+    parser.add_argument("--tolerance", type=float, help="Allowed relative regression per metric.", default=0.1)
+    parser.add_argument(
+        "--startup_tolerance",
+        type=float,
+        help="Allowed relative regression of the startup times, which are short and noisy.",
+        default=0.5
+    )
+    parser.add_argument("--startup_repeats", type=int, help="Startup timings to take the best of (0 skips them).", default=5)
+    parser.add_argument("--startup_only", help="Only time the startup, without running the tasks.", action="store_true")
+    args, forwarded = parser.parse_known_args(argv)
+    if forwarded[:1] == ["--"]:
+        forwarded = forwarded[1:]
+    return args, forwarded
+
+
+def _products(rng: np.random.RandomState, n: int) -> pd.DataFrame:
+    brands = rng.choice(BRANDS, n)
+    return pd.DataFrame({
+        "name": [f"{b} {rng.choice(PRODUCTS)} {rng.randint(100, 9999)}" for b in brands],
+        "description": [f"{rng.choice(PRODUCTS)} by {b}" if rng.rand() < 0.5 else rng.choice(PRODUCTS) for b in brands],
+        "manufacturer": brands,
+        "price": np.round(rng.rand(n) * 500, 2),
+    })
+
+
+def make_entity_resolution(folder: Path, rows: int, rng: np.random.RandomState):
+    """Two product tables where B holds noisy copies of A, with labelled pairs."""
+    n = max(rows, 100)
+    tableA = _products(rng, n).rename(columns={"name": "title"}).drop(columns="description")
+    tableB = tableA.copy()
+    tableB["title"] = [t.lower() if rng.rand() < 0.5 else t + " new" for t in tableB["title"]]
+    tableA.insert(0, "id", range(n))
+    tableB.insert(0, "id", range(n))
+    tableA.to_csv(folder / "tableA.csv", index=False)
+    tableB.to_csv(folder / "tableB.csv", index=False)
+
+    def pairs(num):
+        left = rng.randint(n, size=num)
+        match = rng.rand(num) < 0.5
+        right = np.where(match, left, rng.randint(n, size=num))
+        return pd.DataFrame({"ltable_id": left, "rtable_id": right, "label": (right == left).astype(int)})
+
+    pairs(100).to_csv(folder / "train.csv", index=False)
+    pairs(20).to_csv(folder / "valid.csv", index=False)
+    pairs(rows).to_csv(folder / "test.csv", index=False)
+
+
+def make_data_imputation(folder: Path, rows: int, rng: np.random.RandomState):
+    _products(rng, 200).to_csv(folder / "train.csv", index=False)
+    _products(rng, 20).to_csv(folder / "valid.csv", index=False)
+    _products(rng, rows).to_csv(folder / "test.csv", index=False)
+
+
+def make_data_transformation(folder: Path, rows: int, rng: np.random.RandomState):
+    """Date-format benchmark files of 3 examples and up to 20 test rows each."""
+    per_file = 20
+    for f, start in enumerate(range(0, rows, per_file)):
+        lines = ["convert date format %d" % f]
+        for _ in range(3 + min(per_file, rows - start)):
+            y, m, d = rng.randint(1990, 2030), rng.randint(1, 13), rng.randint(1, 29)
+            lines.append("%04d%02d%02d\t\t%04d-%02d-%02d" % (y, m, d, y, m, d))
+        (folder / f"t{f}.txt").write_text("\n".join(lines) + "\n")
+
+
+MAKERS = {
+    "entity_resolution": make_entity_resolution,
+    "data_imputation": make_data_imputation,
+    "data_transformation": make_data_transformation,
+}
+
+
+def make_datasets(root: Path, tasks: List[str], rows: int, seed: int) -> Dict[str, Path]:
+    folders = {}
+    for task in tasks:
+        folder = root / "data" / TASK_DATASETS[task]
+        folder.mkdir(parents=True, exist_ok=True)
+        MAKERS[task](folder, rows, np.random.RandomState(seed))
+        folders[task] = folder
+    return folders
+
+
+def _run_task(argv: List[str]) -> Dict:
+    start = time.perf_counter()
+    output_file = inference.main(argv)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {"seconds": seconds, "peak_rss_mb": rss, "telemetry": json.load(open(output_file.parent / "telemetry.json"))}
+
+
+def measure_startup(task: str, data_dir: Path, repeats: int) -> Dict:
+    """Best wall time of `repeats` imports of `inference` and `--dry_run`s, each in a fresh interpreter."""
+    commands = {
+        "import_seconds": [sys.executable, "-c", "import inference"],
+        "dry_run_seconds": [
+            sys.executable, "inference.py", "--dry_run", "--api_key", "mock", "--task", task, "--data_dir", str(data_dir)
+        ],
+    }
+    startup = {}
+    for name, command in commands.items():
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=Path(__file__).resolve().parent)
+            seconds.append(time.perf_counter() - start)
+        startup[name] = min(seconds)
+    return startup
+
+
+def summarize(run: Dict, rows: int) -> Dict:
+    telemetry = run["telemetry"]
+    total, row_seconds = telemetry["total"], telemetry["row_seconds"]
+    return {
+        "rows": rows,
+        "seconds": run["seconds"],
+        "rows_per_sec": rows / max(run["seconds"], 1e-9),
+        "row_p50": row_seconds.get("p50", 0.0),
+        "row_p95": row_seconds.get("p95", 0.0),
+        "row_p99": row_seconds.get("p99", 0.0),
+        "calls": total["calls"],
+        "calls_per_row": total["calls"] / max(1, rows),
+        "retries": total["retries"],
+        "llm_p95": total["latency"].get("p95", 0.0),
+        "peak_rss_mb": run["peak_rss_mb"],
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float, startup_tolerance: float) -> List[str]:
+    """Log every compared metric against the baseline; returns the regressions."""
+    ignored = {"tolerance", "startup_tolerance", "mock_requests", "mock_errors", "startup_only", "startup_repeats"}
+    config = {k: v for k, v in results["config"].items() if k not in ignored}
+    differing = [k for k, v in config.items() if baseline["config"].get(k) != v]
+    if differing:
+        logger.warning(f"Baseline was run with different settings: {', '.join(differing)}")
+    sections = [
+        (task, metrics, baseline["tasks"].get(task), COMPARED, tolerance) for task, metrics in results["tasks"].items()
+    ]
+    sections.append(("startup", results.get("startup"), baseline.get("startup"), STARTUP_COMPARED, startup_tolerance))
+    regressions = []
+    for name, metrics, base, compared, allowed in sections:
+        if not metrics or not base:
+            continue
+        for metric, higher_is_better in compared.items():
+            old, new = base[metric], metrics[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > allowed else ""
+            logger.info(f"{name:20s} {metric:14s} {old:10.3f} -> {new:10.3f} ({change:+.1%}) {flag}")
+            if flag:
+                regressions.append(f"{name} {metric} {old:.3f} -> {new:.3f}")
+    return regressions
+
+
+def finish(args, results: Dict) -> Dict:
+    """Write the results and compare them with the baseline."""
+    if args.output:
+        json.dump(results, open(args.output, "w"), indent=2)
+        logger.info(f"Results written to {args.output}")
+    if args.compare:
+        regressions = compare(results, json.load(open(args.compare)), args.tolerance, args.startup_tolerance)
+        if regressions:
+            raise SystemExit("Regressions:\n%s" % "\n".join(regressions))
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(module)s] [%(levelname)s] %(message)s")
+    args, forwarded = parse_args(argv)
+    root = Path(args.work_dir or tempfile.mkdtemp(prefix="unidm-bench-"))
+    folders = make_datasets(root, args.tasks, args.rows, args.seed)
+    results = {"config": {k: v for k, v in vars(args).items() if k not in {"output", "compare", "work_dir"}}, "tasks": {}}
+    results["config"]["forwarded"] = forwarded
+    if args.startup_repeats > 0:
+        results["startup"] = measure_startup(args.tasks[0], folders[args.tasks[0]], args.startup_repeats)
+        logger.info(f"startup: {json.dumps(results['startup'])}")
+    if args.startup_only:
+        return finish(args, results)
+
+    server = MockCompletionServer(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    ).start()
+    # Spawned processes, one per task, so peak RSS is measured per task
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        for task in args.tasks:
+            output_dir = root / "outputs" / task
+            # No client-side rate limit unless forwarded, so the pipeline is timed rather than the token bucket
+            argv = ["--rpm", "0", "--tpm", "0"] + forwarded + [
+                "--task", task,
+                "--data_dir", str(folders[task]),
+                "--api_key", "mock",
+                "--api_base", server.url,
+                "--client", "openai",
+                "--output_dir", str(output_dir),
+                "--data_cache_dir", "",
+                "--prompt_cache", "",
+                "--score_store", str(output_dir / "scores.sqlite"),
+                "--instance_wise",
+                "--data_parsing",
+            ]
+            with ctx.Pool(1, maxtasksperchild=1) as pool:
+                run = pool.apply(_run_task, (argv,))
+            results["tasks"][task] = summarize(run, args.rows)
+            logger.info(f"{task}: {json.dumps(results['tasks'][task])}")
+    finally:
+        server.stop()
+    results["config"]["mock_requests"] = server.num_requests
+    results["config"]["mock_errors"] = server.num_errors
+    return finish(args, results)
+
+
+if __name__ == "__main__":
+    main()
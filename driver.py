@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Run many (task, dataset, config) jobs, each split into test shards, in a process pool.
+
+    python driver.py --jobs jobs.json --processes 8 --api_key <KEY> --instance_wise
+    python driver.py --suite --data_root dataset/datasets --num_shards 4 --api_key <KEY>
+
+`jobs.json` is a list of jobs such as
+    [{"task": "entity_resolution", "data_dir": "dataset/datasets/entity_matching/structured/Beer",
+      "num_shards": 2, "args": {"instance_wise": true, "context_num": 20}}]
+where "args" are `inference.py` flags (true for switches). Flags the driver does not
+know are passed to every job. All processes share one --rpm/--tpm budget, and each
+job's shards are merged into the usual `trial.feather`/`metrics.json` layout.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+import inference
+from utils.constants import IMPUTE_COLS, MATCH_PROD_NAME
+from utils.data_utils import read_data
+from utils.dispatch import SharedTokenBucket, share_limits
+from utils.utils import count_metrics, metrics_from_counts
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Generate args; unknown flags are forwarded to every job."""
+    parser = argparse.ArgumentParser(description="Run UniDM jobs over test shards in a process pool.")
+    parser.add_argument("--jobs", type=str, help="JSON file with a list of jobs.", default=None)
+    parser.add_argument(
+        "--suite",
+        help="Add an entity resolution job for every dataset in MATCH_PROD_NAME and an imputation job for every dataset in IMPUTE_COLS found under --data_root.",
+        action="store_true"
+    )
+    parser.add_argument("--data_root", type=str, help="Where --suite looks for dataset folders.", default="dataset")
+    parser.add_argument("--num_shards", type=int, help="Default number of test shards per job.", default=1)
+    parser.add_argument("--processes", type=int, help="Worker processes.", default=multiprocessing.cpu_count())
+    parser.add_argument("--rpm", type=float, help="Requests per minute shared by all processes (0 disables).", default=3000)
+    parser.add_argument("--tpm", type=float, help="Tokens per minute shared by all processes (0 disables).", default=250000)
+    args, forwarded = parser.parse_known_args(argv)
+    if forwarded[:1] == ["--"]:
+        forwarded = forwarded[1:]
+    if args.jobs is None and not args.suite:
+        parser.error("give --jobs and/or --suite")
+    return args, forwarded
+
+
+def _flags(config: Dict) -> List[str]:
+    argv = []
+    for k, v in config.items():
+        if v is True:
+            argv.append(f"--{k}")
+        elif v is False or v is None:
+            continue
+        elif isinstance(v, (list, tuple)):
+            argv += [f"--{k}"] + [str(x) for x in v]
+        else:
+            argv += [f"--{k}", str(v)]
+    return argv
+
+
+def suite_jobs(data_root: str) -> List[Dict]:
+    """One job per benchmark dataset folder found under `data_root`."""
+    folders = {p.name: p for p in sorted(Path(data_root).rglob("*")) if p.is_dir()}
+    jobs = []
+    for task, names in [("entity_resolution", MATCH_PROD_NAME), ("data_imputation", IMPUTE_COLS)]:
+        for name in names:
+            if name in folders:
+                jobs.append({"task": task, "data_dir": str(folders[name])})
+            else:
+                logger.warning(f"No folder for {name} under {data_root}, skipping")
+    return jobs
+
+
+def _init_worker(request_bucket, token_bucket):
+    share_limits(request_bucket, token_bucket)
+
+
+def _run_shard(argv: List[str]):
+    try:
+        return argv, str(inference.main(argv)), None
+    except Exception:
+        return argv, None, traceback.format_exc()
+
+
+def merge_shards(task: str, shard_files: List[Path], output_file: Path):
+    """Concatenate shard predictions in shard order and recompute the metrics over all rows."""
+    counts = None
+    if output_file.suffix == ".feather":
+        merged = pd.concat([pd.read_feather(f) for f in shard_files], ignore_index=True)
+        merged.to_feather(output_file)
+        counts = count_metrics(merged["preds"], merged["label_str"], task)
+    else:
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for f in shard_files:
+                for batch in pq.ParquetFile(f).iter_batches():
+                    if writer is None:
+                        writer = pq.ParquetWriter(output_file, batch.schema)
+                    writer.write_batch(batch)
+                    columns = batch.to_pydict()
+                    counts = count_metrics(columns["preds"], columns["label_str"], task, counts)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    prec, rec, acc, f1 = metrics_from_counts(counts or count_metrics([], [], task))
+    trial_metrics = {"prec": [prec], "rec": [rec], "f1": [f1], "acc": [acc]}
+    json.dump(trial_metrics, open(output_file.parent / "metrics.json", "w"))
+    return trial_metrics
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(module)s] [%(levelname)s] %(message)s")
+    args, forwarded = parse_args(argv)
+
+    jobs = json.load(open(args.jobs)) if args.jobs else []
+    if args.suite:
+        jobs += suite_jobs(args.data_root)
+
+    # Expand every job into one argv per shard
+    shards, plans = [], []
+    for job in jobs:
+        num_shards = job.get("num_shards", args.num_shards)
+        job_argv = forwarded + _flags(job.get("args", {})) + ["--task", job["task"], "--data_dir", job["data_dir"]]
+        job_args = inference.parse_args(job_argv + ["--num_shards", "1"])
+        shard_argvs = [job_argv + ["--num_shards", str(num_shards), "--shard_index", str(i)] for i in range(num_shards)]
+        plans.append((job_args, shard_argvs))
+        shards += shard_argvs
+
+        # Prepare the dataset once here rather than racing to do it in every shard
+        if job_args.data_cache_dir and job_args.stream_chunksize <= 0:
+            read_data(
+                task=job_args.task,
+                data_dir=job_args.data_dir,
+                cache_dir=job_args.data_cache_dir,
+                blocking_recall=job_args.blocking_recall,
+            )
+    logger.info(f"{len(jobs)} jobs, {len(shards)} shards, {args.processes} processes")
+
+    # Spawned workers start clean: no inherited logging handlers or threads
+    ctx = multiprocessing.get_context("spawn")
+    request_bucket = SharedTokenBucket(args.rpm, ctx=ctx) if args.rpm > 0 else None
+    token_bucket = SharedTokenBucket(args.tpm, ctx=ctx) if args.tpm > 0 else None
+    outputs, failed = {}, 0
+    # One task per process, so every shard gets fresh logging and frees its memory when done
+    with ctx.Pool(
+        args.processes, initializer=_init_worker, initargs=(request_bucket, token_bucket), maxtasksperchild=1
+    ) as pool:
+        for shard_argv, output_file, error in pool.imap_unordered(_run_shard, shards):
+            if error is not None:
+                failed += 1
+                logger.error(f"Shard {' '.join(shard_argv)} failed:\n{error}")
+            else:
+                outputs[tuple(shard_argv)] = Path(output_file)
+
+    for job_args, shard_argvs in plans:
+        if not all(tuple(a) in outputs for a in shard_argvs):
+            logger.error(f"Not merging {job_args.data_dir}: some shards failed")
+            continue
+        output_file = inference.output_path(job_args)
+        if len(shard_argvs) > 1:
+            trial_metrics = merge_shards(job_args.task, [outputs[tuple(a)] for a in shard_argvs], output_file)
+        else:
+            trial_metrics = json.load(open(output_file.parent / "metrics.json"))
+        logger.info(f"{job_args.task} {job_args.data_dir}: {json.dumps(trial_metrics)} -> {output_file}")
+
+    if failed:
+        raise SystemExit(f"{failed} of {len(shards)} shards failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,23 @@ import os
 import argparse
 import json
 import logging
-import numpy as np
-import pandas as pd
 from pathlib import Path
+from typing import List, Optional
 
-from utils.utils import compute_metrics, setup_logger
-from utils.data_utils import read_data
+# Only light modules at import time: numpy, pandas, rich and the task models are
+# imported by the functions that need them, so --dry_run starts fast
+from utils import constants
 from model import builder
 
 
 logger = logging.getLogger(__name__)
 
+# Arguments that only affect speed or bookkeeping, so they may change between a run and its resume
+RESUMABLE_ARGS = {"api_key", "resume", "checkpoint_every", "max_in_flight", "rpm", "tpm", "max_retries", "row_workers",
+                  "prompt_cache", "prompt_cache_size"}
 
-def parse_args() -> argparse.Namespace:
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     """Generate args."""
     parser = argparse.ArgumentParser(description="You should add those parameter")
     parser.add_argument(
@@ -25,7 +29,7 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="Which task to run.",
         default="data_imputation",
-        choices=["data_imputation", "data_transformation", "entity_resolution"]
+        choices=list(builder.TASKS)
     )
     parser.add_argument(
         "--data_dir",
@@ -33,6 +37,24 @@ def parse_args() -> argparse.Namespace:
         help="The path of dataset.",
         required=True
     )
+    parser.add_argument(
+        "--data_cache_dir",
+        type=str,
+        help="Where prepared (merged, serialized, shuffled) datasets are cached. Empty disables.",
+        default="data_cache"
+    )
+    parser.add_argument(
+        "--stream_chunksize",
+        type=int,
+        help="Read, run and write the test split in chunks of N rows (entity resolution and imputation; 0 disables).",
+        default=0
+    )
+    parser.add_argument(
+        "--blocking_recall",
+        type=float,
+        help="Entity resolution: block the test pairs from tableA/tableB, keeping this share of the labelled train/valid matches (0 reads test.csv).",
+        default=0.0
+    )
     parser.add_argument(
         "--output_dir", 
         type=str, 
@@ -56,6 +78,59 @@ def parse_args() -> argparse.Namespace:
         help="The number of instances to retrieve.",
         default=3
     )    
+    parser.add_argument(
+        "--score_batch_size",
+        type=int,
+        help="Candidates scored per prompt in instance-wise retrieval (1 scores each candidate separately).",
+        default=1
+    )
+    parser.add_argument(
+        "--question_batch_size",
+        type=int,
+        help="Entity resolution pairs asked per prompt under one shared context (1 asks each pair separately).",
+        default=1
+    )
+    parser.add_argument(
+        "--pre_rank",
+        type=int,
+        help="With --instance_wise, LLM-score only the top-M train rows of a local n-gram index instead of a random sample (0 disables).",
+        default=0
+    )
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        help="With --instance_wise, group up to N similar test rows and LLM-score one candidate pool per group (0 disables).",
+        default=0
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        help="Candidates in each group's shared pool (0 uses --context_num).",
+        default=0
+    )
+    parser.add_argument(
+        "--pre_rank_only",
+        help="Retrieve instances by the n-gram index alone, without LLM relevance scoring.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--score_store",
+        type=str,
+        help="SQLite file of instance-retrieval scores keyed by query, candidate, template and model.",
+        default="ret_score/scores.sqlite"
+    )
+    parser.add_argument(
+        "--delta_store",
+        type=str,
+        help="Data imputation: SQLite file of finished rows keyed by their inputs; unchanged rows are reused on re-runs. Empty disables.",
+        default=""
+    )
+    parser.add_argument(
+        "--legacy_score_table",
+        type=str,
+        help="Positional .npy score table from older runs (test rows x --context_num), used for this run only and never stored in --score_store.",
+        default=None
+    )
     parser.add_argument(
         "--metadata_wise",
         help="Set metadata-wise component.",
@@ -71,6 +146,17 @@ def parse_args() -> argparse.Namespace:
         help="Set prompt engineering module.",
         action="store_true"
     )
+    parser.add_argument(
+        "--cascade",
+        help="Try cheap tiers (rules, lexical match, a short logprob prompt) first and run the full pipeline only on rows they are unsure about.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--cascade_threshold",
+        type=float,
+        help="Confidence a cheap tier needs for its answer to be kept.",
+        default=0.9
+    )
     # Model args
     parser.add_argument(
         "--api_key", 
@@ -81,12 +167,265 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--temperature", type=float, help="Temperature.", default=0.0)
     parser.add_argument("--max_tokens", type=int, help="Max tokens to generate.", default=100)
     parser.add_argument("--seed", type=int, default=1234)
-    args = parser.parse_args()
+    parser.add_argument(
+        "--num_trials",
+        type=int,
+        help="Run N trials concurrently with seeds seed..seed+N-1, sharing the prompt cache.",
+        default=1
+    )
+    parser.add_argument(
+        "--bootstrap_resamples",
+        type=int,
+        help="Bootstrap resamples of the test rows for the confidence intervals in metrics_summary.json.",
+        default=1000
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        help="Append finished rows to checkpoint.jsonl in the output folder every N rows.",
+        default=20
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip rows already recorded in the checkpoint of an interrupted run.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--api_base",
+        type=str,
+        help="OpenAI-compatible endpoint, e.g. a local mock server. Manifest is used when unset.",
+        default=None
+    )
+    parser.add_argument("--engine", type=str, help="Model name sent to --api_base.", default="text-davinci-003")
+    parser.add_argument(
+        "--client",
+        type=str,
+        help="LLM backend. Defaults to openai when --api_base is set, else manifest.",
+        default=None,
+        choices=constants.CLIENTS
+    )
+    parser.add_argument(
+        "--prompt_cache",
+        type=str,
+        help="Directory of the sharded response cache shared by runs and processes. Empty disables.",
+        default="prompt_cache"
+    )
+    parser.add_argument(
+        "--prompt_cache_size",
+        type=int,
+        help="Max cached responses, least recently used evicted first (0 is unbounded).",
+        default=1000000
+    )
+    parser.add_argument(
+        "--local_model",
+        type=str,
+        help="With --client local, a llama.cpp .gguf file or a Hugging Face model name/path.",
+        default=None
+    )
+    # Dispatch args
+    parser.add_argument("--max_in_flight", type=int, help="Max concurrent LLM requests.", default=8)
+    parser.add_argument("--rpm", type=float, help="Requests per minute limit (0 disables).", default=3000)
+    parser.add_argument("--tpm", type=float, help="Tokens per minute limit (0 disables).", default=250000)
+    parser.add_argument("--max_retries", type=int, help="Retries on 429/5xx/connection errors.", default=6)
+    parser.add_argument("--row_workers", type=int, help="Test rows processed concurrently.", default=4)
+    parser.add_argument("--num_shards", type=int, help="Split the test rows into this many contiguous shards.", default=1)
+    parser.add_argument("--shard_index", type=int, help="Which shard this process runs.", default=0)
+    parser.add_argument(
+        "--dry_run",
+        "--dry-run",
+        help="Check the arguments and data paths, then exit without reading data or calling the LLM.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--test_rows",
+        type=int,
+        help="Run a fixed random subsample of N test rows, kept in table order; smaller subsamples lie within larger ones (0 runs all).",
+        default=0
+    )
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard_index < max(1, args.num_shards):
+        parser.error("--shard_index must be in [0, --num_shards)")
+    if args.legacy_score_table:
+        # The table scores each row's pool of the old random sampling, by position
+        for flag, conflicts in [("--group_size", args.group_size > 1), ("--pre_rank", args.pre_rank > 0),
+                                ("--pre_rank_only", args.pre_rank_only), ("--delta_store", bool(args.delta_store))]:
+            if conflicts:
+                parser.error(f"--legacy_score_table holds per-row scores of randomly sampled pools and cannot be combined with {flag}")
+    if args.num_trials > 1 and args.num_shards > 1:
+        parser.error("--num_trials cannot be combined with --num_shards")
+    if args.test_rows > 0 and args.stream_chunksize > 0:
+        parser.error("--test_rows cannot be combined with --stream_chunksize")
+    if args.blocking_recall > 0 and args.stream_chunksize > 0:
+        parser.error("--blocking_recall cannot be combined with --stream_chunksize")
     return args
 
-def main():
-    args = parse_args()
-    
+
+def output_path(args: argparse.Namespace, trial: Optional[int] = None) -> Path:
+    """Where a run writes its predictions; shards and trials of a multi-trial run write to their own sub-folder."""
+    folder = Path(args.output_dir) / f"{Path(args.data_dir).stem}" / f"k{args.instance_num}"
+    if args.num_shards > 1:
+        folder = folder / f"shard-{args.shard_index:03d}-of-{args.num_shards:03d}"
+    if trial is not None:
+        folder = folder / f"trial-{trial:02d}"
+    return folder / ("trial.parquet" if args.stream_chunksize > 0 else "trial.feather")
+
+def stream_test_data(args, model, train_data, output_file):
+    """Run the test split chunk by chunk, appending each finished chunk to a Parquet file; returns the confusion counts.
+
+    Only one chunk of rows, predictions and prompts is held in memory at a time.
+    Table columns are written as strings, since CSV chunks may infer different dtypes.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from utils.data_utils import iter_test_data
+    from utils.templates import expand
+    from utils.utils import count_metrics
+
+    counts, writer = None, None
+    try:
+        for test_data in iter_test_data(args.task, args.data_dir, args.stream_chunksize):
+            logger.info(f"Test rows {test_data.index[0]}-{test_data.index[-1]}")
+            preds = model.run(train_data, test_data)
+            test_data = test_data.iloc[slice(*model.shard_bounds(len(test_data)))]
+            counts = count_metrics(preds, test_data["label_str"], args.task, counts)
+
+            save_data = test_data.reset_index()
+            save_data["preds"] = preds
+            save_data["p_as"] = [expand(p) for p in model.p_as]
+            columns = {c: pa.array(save_data[c].astype("string"), type=pa.string()) for c in save_data.columns if c != "index"}
+            chunk = pa.table({"index": pa.array(save_data["index"], type=pa.int64()), **columns})
+            if writer is None:
+                writer = pq.ParquetWriter(output_file, chunk.schema)
+            writer.write_table(chunk)
+
+            model.p_as.clear()
+            model.score_table.clear()
+    finally:
+        if writer is not None:
+            writer.close()
+    return counts or count_metrics([], [], args.task)
+
+
+def run_trial(args, train_data, test_data, output_file: Path, prompt_cache=None):
+    """Run one seeded trial and write its predictions and reports next to `output_file`; returns its confusion counts."""
+    from utils.checkpoint import Checkpoint
+    from utils.templates import expand
+    from utils.utils import count_metrics, metrics_from_counts
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+
+    # UniDM
+    model = builder.build_model(args, logger, prompt_cache)
+    checkpoint_config = {k: v for k, v in vars(args).items() if k not in RESUMABLE_ARGS}
+    model.checkpoint = Checkpoint(
+        output_file.parent / "checkpoint.jsonl",
+        config=checkpoint_config,
+        every=args.checkpoint_every,
+        resume=args.resume,
+    )
+    model.checkpoint.bind_rng(model.rng)
+
+    # Run 
+    if args.stream_chunksize > 0:
+        counts = stream_test_data(args, model, train_data, output_file)
+    else:
+        preds = model.run(train_data, test_data)
+        test_data = test_data.iloc[slice(*model.shard_bounds(len(test_data)))]
+        counts = count_metrics(preds, test_data["label_str"], args.task)
+    model.close()
+
+    # Metric
+    prec, rec, acc, f1 = metrics_from_counts(counts)
+    logger.info(
+        f"Metrics (seed {args.seed})\n"
+        f"Prec: {prec:.3f} Recall: {rec:.3f} Acc: {acc:.3f} F1: {f1:.3f}"
+    )
+
+    # save result
+    logger.info(f"Saved to {output_file}")
+    if args.stream_chunksize <= 0:
+        save_data = test_data.copy(deep=True).reset_index()
+        save_data["preds"] = preds
+        save_data["p_as"] = [expand(p) for p in model.p_as]
+        save_data.to_feather(output_file)
+
+    output_telemetry = output_file.parent / "telemetry.json"
+    model.telemetry.dump(output_telemetry)
+    for stage, stage_counts in model.telemetry.summary()["stages"].items():
+        logger.info(
+            f"{stage}: {stage_counts['calls']} calls, {stage_counts['prompt_tokens']}+{stage_counts['completion_tokens']} tokens, "
+            f"${stage_counts['cost']:.4f}, p95 latency {stage_counts['latency'].get('p95', 0):.2f}s"
+        )
+    logger.info(f"Total cost ${model.get_fee():.4f}, telemetry dumped to {output_telemetry}")
+
+    if args.task == "data_imputation" and model.grouped:
+        output_grouping = output_file.parent / "grouping.json"
+        report = dict(model.group_stats, acc=acc, f1=f1)
+        json.dump(report, open(output_grouping, "w"), indent=2)
+        logger.info(
+            f"Grouped retrieval: {report['rows']} rows scored in {report['groups']} groups, "
+            f"~{report['scoring_calls_saved']} scoring calls saved, acc {acc:.3f}"
+        )
+
+    if args.cascade:
+        output_cascade = output_file.parent / "cascade.json"
+        report = model.cascade_report()
+        json.dump(report, open(output_cascade, "w"), indent=2)
+        for tier, tier_counts in report["tiers"].items():
+            logger.info(f"Cascade {tier}: {tier_counts['rows']} rows ({tier_counts['share']:.1%}), acc {tier_counts['acc']:.3f}")
+        logger.info(f"Cascade escalation rate {report['escalation_rate']:.1%}, report dumped to {output_cascade}")
+    return counts
+
+
+def check_paths(args: argparse.Namespace) -> List[str]:
+    """What would stop a run from reading its inputs, without reading any data."""
+    problems = []
+    data_dir = Path(args.data_dir)
+    dataset_name = args.data_dir.split('/')[-1]
+    if not data_dir.is_dir():
+        return [f"--data_dir {data_dir} is not a directory"]
+    known = {
+        "entity_resolution": constants.MATCH_PROD_NAME,
+        "data_imputation": constants.IMPUTE_COLS,
+        "data_transformation": constants.DATA2DROPCOLS,
+    }[args.task]
+    if dataset_name not in known or dataset_name not in constants.DATA2COLREMAP:
+        problems.append(f"Unknown {args.task} dataset {dataset_name}; add it to utils/constants.py")
+
+    if args.task == "entity_resolution":
+        required = ["tableA.csv", "tableB.csv", "train.csv"] + ([] if args.blocking_recall > 0 else ["test.csv"])
+    elif args.task == "data_imputation":
+        required = ["train.csv", "test.csv"]
+    else:
+        required = []
+        if not any(data_dir.iterdir()):
+            problems.append(f"No data files in {data_dir}")
+    problems += [f"Missing {data_dir / name}" for name in required if not (data_dir / name).exists()]
+
+    if args.legacy_score_table and not Path(args.legacy_score_table).exists():
+        problems.append(f"Missing --legacy_score_table {args.legacy_score_table}")
+    if args.client == "local" and not (args.local_model and Path(args.local_model).exists()):
+        problems.append(f"Missing --local_model {args.local_model}")
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> Path:
+    args = parse_args(argv)
+    if args.dry_run:
+        problems = check_paths(args)
+        if problems:
+            raise SystemExit("Dry run failed:\n" + "\n".join(problems))
+        output_file = output_path(args)
+        print(f"Dry run OK: {args.task} on {args.data_dir} would write {output_file}")
+        return output_file
+
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.data_utils import read_data
+    from utils.dispatch import SharedTokenBucket, has_shared_limits, share_limits
+    from utils.prompt_cache import PromptCache
+    from utils.utils import metrics_from_counts, setup_logger, summarize_trials
+
     # Set api args
     os.environ["OPENAI_API_KEY"] = args.api_key
     dataset_name = args.data_dir.split('/')[-1]
@@ -99,50 +438,90 @@ def main():
     dataset = read_data(
         task=args.task,
         data_dir=args.data_dir,
+        cache_dir=args.data_cache_dir,
+        splits=["train"] if args.stream_chunksize > 0 else ["train", "test", "validation"],
+        blocking_recall=args.blocking_recall,
     )
     train_data = dataset["train"]
-    test_data = dataset["test"]
-    logger.info(f"Test shape is {test_data.shape[0]}")
+    if args.legacy_score_table:
+        # One row of scores per test row and candidate; streamed test splits are not counted up front
+        shape = np.load(args.legacy_score_table, mmap_mode="r").shape
+        num_rows = len(dataset["test"]) if args.stream_chunksize <= 0 else shape[0]
+        if shape != (num_rows, args.context_num):
+            raise SystemExit(
+                f"--legacy_score_table {args.legacy_score_table} has shape {shape}, "
+                f"expected ({num_rows}, {args.context_num}) for the test rows and --context_num"
+            )
+    test_data = None
+    if args.stream_chunksize <= 0:
+        test_data = dataset["test"]
+        if 0 < args.test_rows < len(test_data):
+            # The same permutation for every N, so a subsample is a prefix of any larger one
+            keep = np.random.RandomState(0).permutation(len(test_data))[:args.test_rows]
+            test_data = test_data.iloc[np.sort(keep)]
+        logger.info(f"Test shape is {test_data.shape[0]}")
 
-    # UniDM
-    model = builder.build_model(args, logger)
-        
-    # Run 
-    preds = model.run(train_data, test_data)
+    if args.num_trials <= 1:
+        output_file = output_path(args)
+        trial_counts = [run_trial(args, train_data, test_data, output_file)]
+    else:
+        # Trials differ only in their seed; they run concurrently and share one
+        # prompt cache and one rate limit budget, so repeated prompts are paid once
+        prompt_cache = None
+        if args.prompt_cache:
+            prompt_cache = PromptCache(args.prompt_cache, max_entries=args.prompt_cache_size)
+        own_limits = not has_shared_limits()
+        if own_limits:
+            share_limits(
+                SharedTokenBucket(args.rpm) if args.rpm > 0 else None,
+                SharedTokenBucket(args.tpm) if args.tpm > 0 else None,
+            )
+        trials = [
+            (argparse.Namespace(**dict(vars(args), seed=args.seed + t)), output_path(args, trial=t))
+            for t in range(args.num_trials)
+        ]
+        try:
+            with ThreadPoolExecutor(max_workers=args.num_trials, thread_name_prefix="unidm-trial") as executor:
+                futures = [
+                    executor.submit(run_trial, trial_args, train_data, test_data, trial_file, prompt_cache)
+                    for trial_args, trial_file in trials
+                ]
+                trial_counts = [f.result() for f in futures]
+        finally:
+            if prompt_cache is not None:
+                stats = prompt_cache.stats()
+                logger.info(
+                    f"Prompt cache {stats['path']}: {stats['hits']} hits, {stats['misses']} misses "
+                    f"(hit rate {stats['hit_rate']:.1%}) over {args.num_trials} trials"
+                )
+                prompt_cache.close()
+            if own_limits:
+                share_limits()
+        output_file = trials[0][1]
 
     # Metric
     trial_metrics = {"prec": [], "rec": [], "f1": [], "acc": []}
-    gt = test_data["label_str"]
-    prec, rec, acc, f1 = compute_metrics(preds, gt, args.task)
-
-    logger.info(
-        f"Metrics\n"
-        f"Prec: {prec:.3f} Recall: {rec:.3f} Acc: {acc:.3f} F1: {f1:.3f}"
-    )
-    trial_metrics["rec"].append(rec)
-    trial_metrics["prec"].append(prec)
-    trial_metrics["acc"].append(acc)
-    trial_metrics["f1"].append(f1)
+    for counts in trial_counts:
+        prec, rec, acc, f1 = metrics_from_counts(counts)
+        trial_metrics["rec"].append(rec)
+        trial_metrics["prec"].append(prec)
+        trial_metrics["acc"].append(acc)
+        trial_metrics["f1"].append(f1)
 
-    # save result
-    output_file = (
-            Path(args.output_dir)
-            / f"{Path(args.data_dir).stem}"
-            / f"k{args.instance_num}"
-            / f"trial.feather"
-        )
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-    logger.info(f"Saved to {output_file}")
-    save_data = test_data.copy(deep=True).reset_index()
-    save_data["preds"] = preds
-    save_data["p_as"] = model.p_as
-    save_data.to_feather(output_file)
-
-    output_metrics = output_file.parent / "metrics.json"
+    output_metrics = output_path(args).parent / "metrics.json"
     json.dump(trial_metrics, open(output_metrics, "w"))
     logger.info(f"Final Metrics {json.dumps(trial_metrics, indent=4)}")
     logger.info(f"Metrics dumped to {output_metrics}")
 
+    summary = summarize_trials(trial_counts, num_resamples=args.bootstrap_resamples, seed=args.seed)
+    json.dump(dict(summary, trials=len(trial_counts)), open(output_metrics.parent / "metrics_summary.json", "w"), indent=2)
+    for name, stats in summary.items():
+        logger.info(
+            f"{name}: {stats['mean']:.3f} +/- {stats['std']:.3f} over {len(trial_counts)} trials, "
+            f"95% CI [{stats['ci'][0]:.3f}, {stats['ci'][1]:.3f}]"
+        )
+    return output_file
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,20 +1,28 @@
-from model.unidm_di import UniDM_DataImputation
-from model.unidm_dt import UniDM_DataTransformation
-from model.unidm_em import UniDM_EntityResolution
+import importlib
 
+# Task -> (module, class); a task's module is only imported when the task runs
+TASKS = {
+    "data_imputation": ("model.unidm_di", "UniDM_DataImputation"),
+    "data_transformation": ("model.unidm_dt", "UniDM_DataTransformation"),
+    "entity_resolution": ("model.unidm_er", "UniDM_EntityResolution"),
+}
 
-def build_model(args, logger):
+
+def model_class(task):
+    """
+    The model class of a task
+    """
+    if task not in TASKS:
+        raise ValueError('Unrecognized Task:%s.' % task)
+    module, name = TASKS[task]
+    return getattr(importlib.import_module(module), name)
+
+
+def build_model(args, logger, prompt_cache=None):
     """
     Builds the model 
     """
 
-    if args.task == "data_imputation":
-        UniDM = UniDM_DataImputation(args, logger)
-    elif args.task == "data_transformation":
-        UniDM = UniDM_DataTransformation(args, logger)
-    elif args.task == "entity_resolution":
-        UniDM = UniDM_EntityResolution(args, logger)
-    else:
-        raise ValueError('Unrecognized Task:%s.' % args.task)
+    UniDM = model_class(args.task)(args, logger, prompt_cache)
 
-    return UniDM
\ No newline at end of file
+    return UniDM
@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
-import os, time
-from manifest import Manifest
+import math
 
+import numpy as np
 
-TIMESLEEP = 1
+from utils.clients import build_client
+from utils.dispatch import Dispatcher
+from utils.pipeline import RowPipeline
+from utils.prompt_cache import PromptCache
+from utils.telemetry import Telemetry, current_scope
+from utils.templates import expand
+from utils.utils import count_metrics, metrics_from_counts
 
 
 class UniDM():
-    def __init__(self, args, logger):
+    # Task name used to score predictions, see `count_metrics`
+    task = None
+
+    def __init__(self, args, logger, prompt_cache=None):
         self.context_num = args.context_num
         self.instance_num = args.instance_num
         self.instance_wise = args.instance_wise
@@ -16,29 +25,247 @@ class UniDM():
         self.Data_Parsing = args.data_parsing
         self.Prompt_Engineering = args.prompt_engineering
         self.logger = logger
-        self.manifest = Manifest(
-            client_name='openai',
-            cache_name='sqlite',
-            cache_connection='unifdt.sqlite',
-            stop_token='\n',
-            temperature=args.temperature,
+        self.stop_token = '\n'
+        self.engine = args.engine
+        self.temperature = args.temperature
+        self.max_tokens = args.max_tokens
+        self.client = client = build_client(args)
+        # A cache passed in is shared with other models of this process and left open by `close`
+        self.prompt_cache = prompt_cache
+        self.owns_prompt_cache = prompt_cache is None and bool(args.prompt_cache)
+        if self.owns_prompt_cache:
+            self.prompt_cache = PromptCache(args.prompt_cache, max_entries=args.prompt_cache_size)
+        self.dispatcher = Dispatcher(
+            client,
+            max_in_flight=args.max_in_flight,
+            rpm=args.rpm,
+            tpm=args.tpm,
             max_tokens=args.max_tokens,
-            top_p=1.0,
-            n=1,
+            max_retries=args.max_retries,
+            logger=logger,
         )
 
+        # Own RNG so sampling stays reproducible however many rows run at once
+        self.rng = np.random.RandomState(args.seed)
+        self.row_workers = args.row_workers
+
+        # This process runs one contiguous block of the test rows of each `run`
+        self.shard_index = args.shard_index
+        self.num_shards = max(1, args.num_shards)
+
+        # Set by the caller to record finished rows and skip them on resume
+        self.checkpoint = None
+        # Train-side setup is done once, however many test chunks are run
+        self.prepared = False
+
+        # Rows a cheap tier answers with at least this confidence skip the full pipeline
+        self.cascade = args.cascade
+        self.cascade_threshold = args.cascade_threshold
+        self.cascade_counts = {}
+
+        # Answer prompts of the finished rows, mostly as template references expanded on output
         self.p_as = []
         self.score_table = []
-        self.total_num_toks = 0
+        self.telemetry = Telemetry(args.engine)
+
+    def complete(self, prompts):
+        """
+        Answer prompts from the prompt cache, dispatching only the misses (each distinct prompt once).
+        A miss that another model sharing the cache has in flight waits for that request instead.
+        :param prompts: The prompts, answered in input order.
+        """
+        if self.prompt_cache is None:
+            return self.dispatcher.run_batch(prompts, stop_token=self.stop_token)
+
+        keys = [
+            PromptCache.key(self.client.model_id, p, self.temperature, self.max_tokens, self.stop_token)
+            for p in prompts
+        ]
+        found, waiting, owned = self.prompt_cache.lookup(keys)
+        if owned:
+            to_send = dict(zip(keys, prompts))
+            try:
+                completions = self.dispatcher.run_batch([to_send[k] for k in owned], stop_token=self.stop_token)
+            except BaseException as e:
+                self.prompt_cache.abandon(owned, e)
+                raise
+            fresh = dict(zip(owned, completions))
+            self.prompt_cache.fulfil(fresh)
+            found.update(fresh)
+        # Our own requests go out before we wait, so two callers never wait on each other
+        for k, future in waiting.items():
+            found[k] = future.result()
+        return [found[k] for k in keys]
 
     def apply_prompt(self, prompt):
-        res = self.manifest.run(prompt=prompt)
-        self.total_num_toks += len(prompt) // 4
-        time.sleep(TIMESLEEP)
-        return res
+        prompt = expand(prompt)
+        stage, row = current_scope()
+        completion = self.complete([prompt])[0]
+        self.telemetry.record(prompt, completion, stage, row)
+        return completion.text
+
+    def apply_prompts(self, prompts):
+        """
+        Dispatch independent prompts concurrently, results come back in input order.
+        """
+        prompts = [expand(p) for p in prompts]
+        stage, row = current_scope()
+        completions = self.complete(prompts)
+        for prompt, completion in zip(prompts, completions):
+            self.telemetry.record(prompt, completion, stage, row)
+        return [completion.text for completion in completions]
+
+    def apply_prompt_with_confidence(self, prompt):
+        """
+        Answer one prompt and return (text, probability of the answer), the probability None when the
+        client cannot report logprobs. Skips the prompt cache, which does not keep logprobs.
+        """
+        prompt = expand(prompt)
+        stage, row = current_scope()
+        completion = self.dispatcher.run(prompt, stop_token=self.stop_token, logprobs=True)
+        self.telemetry.record(prompt, completion, stage, row)
+        prob = math.exp(completion.logprob) if completion.logprob is not None else None
+        return completion.text, prob
+
+    def shard_bounds(self, num_rows):
+        """
+        The [start, end) positions of this process's block of `num_rows` test rows.
+        """
+        return num_rows * self.shard_index // self.num_shards, num_rows * (self.shard_index + 1) // self.num_shards
+
+    def is_done(self, state):
+        """
+        Whether a row needs no more pipeline work: answered by a cascade tier, or finished in the checkpoint.
+        """
+        return "tier" in state or (self.checkpoint is not None and self.checkpoint.is_finished(state["id"]))
+
+    def pending(self, rows):
+        """
+        The rows this process still has to run: its shard of `rows`, minus rows already done.
+        """
+        start, end = self.shard_bounds(len(rows))
+        return [r for r in rows[start:end] if not self.is_done(r)]
+
+    def cascade_tiers(self):
+        """
+        Cheap (name, callable) tiers tried in order before the full pipeline. Each callable takes a row
+        state and returns (pred, confidence), or None when it has no answer.
+        """
+        return []
+
+    def cascade_stage(self, state):
+        for name, tier in self.cascade_tiers():
+            answer = tier(state)
+            if answer is not None and answer[1] >= self.cascade_threshold:
+                state["pred"], state["confidence"] = answer
+                state["tier"] = name
+                state.setdefault("prompt_as", "")
+                self.logger.info(f"idx:{state['id']} ====> pred:{state['pred']} ({name}, {answer[1]:.2f})")
+                break
+        return state
+
+    def early_exit(self, rows):
+        """
+        Try the cascade tiers on every pending row; rows answered confidently skip the full pipeline.
+        :param rows: Planned row state dicts, updated in place.
+        """
+        if not self.cascade:
+            return
+        todo = self.pending(rows)
+        RowPipeline([("cascade", self.cascade_stage)], num_workers=self.row_workers).run(todo)
+        exited = sum(1 for r in todo if "tier" in r)
+        self.logger.info(f"Cascade: {exited}/{len(todo)} rows answered before the full pipeline")
+
+    def run_rows(self, rows, stages):
+        """
+        Run the per-row stage chain over this process's shard of `rows` with `row_workers` rows in flight.
+        Every row is planned, so sampling does not depend on the sharding.
+        :param rows: Row state dicts in input order, with all sampling already done.
+        :param stages: (name, callable) pairs, each taking and returning a row state.
+        """
+        start, end = self.shard_bounds(len(rows))
+        rows = rows[start:end]
+        todo = [r for r in rows if not self.is_done(r)]
+        exited = [r for r in rows if "tier" in r]
+        if self.checkpoint is None:
+            pipeline = RowPipeline(stages, num_workers=self.row_workers)
+            done = pipeline.run(todo)
+        else:
+            finished = len(rows) - len(todo) - len(exited)
+            if finished:
+                self.logger.info(f"Skipping {finished} rows finished in {self.checkpoint.path}")
+            try:
+                for r in exited:
+                    self.checkpoint_stage(r)
+                pipeline = RowPipeline(stages + [("checkpoint", self.checkpoint_stage)], num_workers=self.row_workers)
+                done = pipeline.run(todo)
+            finally:
+                self.checkpoint.flush()
+        self.telemetry.record_row_seconds(pipeline.row_seconds)
+        self.telemetry.finish_rows(r["id"] for r in rows)
+        done = {str(r["id"]): r for r in done + exited}
+        results = [done.get(str(r["id"])) or self.checkpoint.finished[str(r["id"])] for r in rows]
+        if self.cascade:
+            self.count_tiers(rows, results)
+        return results
+
+    def checkpoint_stage(self, state):
+        keys = ("id", "pred", "prompt_as", "score", "tier", "confidence")
+        record = {k: state[k] for k in keys if k in state}
+        if "prompt_as" in record:
+            record["prompt_as"] = expand(record["prompt_as"])
+        self.checkpoint.add(record)
+        return state
+
+    def count_tiers(self, rows, results):
+        """
+        Accumulate the metric counts of each cascade tier; rows that ran the full pipeline count as "full".
+        Rows reused from the delta store were answered by an earlier run and are left out.
+        """
+        by_tier = {}
+        for row, result in zip(rows, results):
+            if result.get("tier") == "delta":
+                continue
+            preds, labels = by_tier.setdefault(result.get("tier") or "full", ([], []))
+            preds.append(result["pred"])
+            labels.append(row["label"])
+        for tier, (preds, labels) in by_tier.items():
+            self.cascade_counts[tier] = count_metrics(preds, labels, self.task, self.cascade_counts.get(tier))
+
+    def cascade_report(self):
+        """
+        The escalation rate and the share and accuracy of each tier over every row run so far.
+        """
+        total = sum(c["total"] for c in self.cascade_counts.values())
+        tiers = {}
+        for name, counts in self.cascade_counts.items():
+            prec, rec, acc, f1 = metrics_from_counts(counts)
+            tiers[name] = {"rows": counts["total"], "share": counts["total"] / max(1, total), "acc": acc, "f1": f1}
+        escalated = self.cascade_counts.get("full", {}).get("total", 0)
+        return {
+            "threshold": self.cascade_threshold,
+            "rows": total,
+            "escalation_rate": escalated / max(1, total),
+            "tiers": tiers,
+        }
+
+    def close(self):
+        self.dispatcher.close()
+        if self.owns_prompt_cache:
+            stats = self.prompt_cache.stats()
+            self.logger.info(
+                f"Prompt cache {stats['path']}: {stats['hits']} hits, {stats['misses']} misses "
+                f"(hit rate {stats['hit_rate']:.1%}), {stats['entries']} entries, {stats['evictions']} evicted"
+            )
+            self.prompt_cache.close()
+
+    @property
+    def total_num_toks(self):
+        totals = self.telemetry.totals()
+        return totals["prompt_tokens"] + totals["completion_tokens"]
 
     def get_fee(self):
-        return self.total_num_toks*0.02/1000
+        return self.telemetry.totals()["cost"]
 
     def get_prompt(self, table):
         """
@@ -61,6 +288,7 @@ class UniDM():
     def data_parsing(self, context):
         """
         Adaptive data parsing module.
+        :param context: The serialized lines to parse.
         """
         raise NotImplementedError("")
 
@@ -72,6 +300,13 @@ class UniDM():
         """
         raise NotImplementedError("")
 
+    def prepare(self, train):
+        """
+        One-off setup that depends on the train split only, shared by every test chunk.
+        :param train: The dataset to get the context.
+        """
+        self.prepared = True
+
     def run(self, train, test):
         """
         Unified Framework for Data and Task with Large Language Models towards a Feature-rich Data Lake.
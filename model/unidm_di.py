@@ -1,21 +1,108 @@
 #!/usr/bin/env python
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
-import os
+import hashlib
+import math
 import pandas as pd
 import numpy as np
 
 from model.unidm_base import UniDM
 from utils.constants import IMPUTE_COLS
-from utils.data_utils import serialize_row
+from utils.data_utils import serialize_frame
+from utils.delta_store import DeltaStore
+from utils.pipeline import RowPipeline
+from utils.retrieval import NGramIndex, normalize_text
+from utils.score_store import ScoreStore
+from utils.telemetry import scope
+from utils.templates import Template, parse_indexed_reply
+
+
+SCORE_RUBRIC = """Use the following scoring system:\n0 - Not relevant at all\n1 - Slightly relevant \n2 - Moderately relevant\n3 - Highly relevant\n\n"""
+PARSE_PROMPT = Template(
+    "di.data_parsing",
+    "Given the items and convert the them into a textual format in a logical order.\n The items are {items}\n",
+)
+METADATA_PROMPT = Template(
+    "di.metadata_retrieval",
+    "The task is data imputation. The target query is '{column}'.\n"
+    "The attributes about '{dataset}' are {attributes}.\n"
+    "Which attribute is the most helpful for task and query?\nGive me ID only: ",
+)
+SCORE_PROMPT = Template(
+    "di.score",
+    "The task is data imputation.\nThe target query is '{target}'.\n"
+    "The give instance is '{instance}'\n"
+    "Score the relevance of give instance to target query.\n" + SCORE_RUBRIC + "(0/1/2/3):",
+)
+BATCH_SCORE_ITEM_PROMPT = Template("di.batch_score_item", "[{num}] '{instance}'\n")
+BATCH_SCORE_PROMPT = Template(
+    "di.batch_score",
+    "The task is data imputation.\nThe target query is '{target}'.\n"
+    "The given instances are:\n{instances}"
+    "Score the relevance of each given instance to target query.\n" + SCORE_RUBRIC +
+    "Answer in one line as [id] score for all {num} instances, e.g. [1] 2 [2] 0\nScores:",
+)
+CLOZE_PROMPT = "Claim:\nThe context is {context} The target is {target}\nCloze question:\n"
+# Few-shot cloze question examples: one for Restaurant, one for every other dataset
+RESTAURANT_CLOZE_PROMPT = Template(
+    "di.prompt_engineering.restaurant",
+    "Write the claim as a clozen question.\n\nClaim:\nThe context is Wenham, Marysville, and Westmont are cities in the United States, identified by the ISO3 code USA. The target is city: New Cassel iso3: USA country: __\nCloze question:\nWenham, Marysville, and Westmont are cities in the United States, identified by the ISO3 code USA.\nNew Cassel is the name of a city whose ISO3 country code is USA. New Kassel belongs to the country __.\n\n"
+    + CLOZE_PROMPT,
+)
+PRODUCT_CLOZE_PROMPT = Template(
+    "di.prompt_engineering.product",
+    "Write the claim as a clozen question.\n\nClaim:\nThe context is The Griffin Protective Wave Case for Smart Phone - 8227-IP2WVB is a black case designed for the iPhone 3G, manufactured by Griffin. The target is name: Panasonic KX-TCA86 Headset description: Over-the-head manufacturer: __\nClozen question:\nThe manufacturer is __. [Pure Digital Technol,LG Electronics,ELGATO SYSTEMS,Samsung,Monster]\nThe Griffin Protective Wave Case for Smart Phone - 8227-IP2WVB is a black case designed for the iPhone 3G. The manufacturer is __.[Griffin]\nThe Panasonic KX-TCA86 Headset is an over-the-head headset. The manufacturer is __.[]\n\n"
+    + CLOZE_PROMPT,
+)
+ANSWER_PROMPT = Template("di.answer", "Follow the example to impute the missing value.\n{context}{target}\nAnswer:")
+PARSED_ANSWER_PROMPT = Template("di.answer.parsed", "{context}\n{target}\nAnswer:")
+CLOZE_ANSWER_PROMPT = Template("di.answer.cloze", "{question}\nAnswer:")
+LOGPROB_PROMPT = Template("di.logprob", "The task is data imputation.\n{target}\nGive the {column} only.\nAnswer:")
+# Arguments a stored prediction depends on besides the row and its retrieval pool
+DELTA_ARGS = (
+    "engine", "temperature", "max_tokens", "instance_wise", "metadata_wise", "data_parsing", "prompt_engineering",
+    "context_num", "instance_num", "pre_rank", "pre_rank_only", "score_batch_size", "cascade", "cascade_threshold",
+    "group_size", "pool_size",
+)
+
+
+def parse_batch_scores(gen_text, num):
+    """
+    Parse a "[1] 2 [2] 0 ..." reply into `num` scores, None for items that are not a score from 0 to 3.
+    """
+    return parse_indexed_reply(gen_text, num, lambda v: int(v) if v in ("0", "1", "2", "3") else None)
 
 
 class UniDM_DataImputation(UniDM):
-    def __init__(self, args, logger):
-        super().__init__(args, logger)
-        self.prompt_dp = "Given the items and convert the them into a textual format in a logical order.\n The items are %s\n"
+    task = "data_imputation"
+
+    def __init__(self, args, logger, prompt_cache=None):
+        super().__init__(args, logger, prompt_cache)
+        self.prompt_dp = PARSE_PROMPT
         self.dataset_name = args.data_dir.split('/')[-1]
         self.impute_col = IMPUTE_COLS[self.dataset_name]
         self.load_score_table, self.score_table = [], []
+        self.score_batch_size = args.score_batch_size
+        # Lexical pre-ranking: LLM-score only the `pre_rank` nearest train rows
+        self.pre_rank_only = args.pre_rank_only
+        self.pre_rank = args.pre_rank or (args.instance_num if args.pre_rank_only else 0)
+        self.index = None
+        # Grouped retrieval: similar test rows share one LLM-scored candidate pool
+        self.group_size = args.group_size
+        self.pool_size = args.pool_size or args.context_num
+        self.grouped = self.instance_wise and not self.pre_rank_only and self.group_size > 1
+        self.group_stats = {"groups": 0, "rows": 0, "scoring_queries_saved": 0, "scoring_calls_saved": 0}
+        self.score_store = ScoreStore(args.score_store)
+        if args.legacy_score_table:
+            # Positional tables from earlier runs; only valid for the same seed and sampling,
+            # so they are never imported into the score store
+            self.load_score_table = np.load(args.legacy_score_table)
+        # Cascade: train values of the imputed column, and the index the lexical tier votes with
+        self.value_vocab = {}
+        self.cascade_index = None
+        # Delta mode: reuse the predictions of rows whose inputs did not change since an earlier run
+        self.seed = args.seed
+        self.delta_store = DeltaStore(args.delta_store) if args.delta_store else None
+        self.delta_config = dict({k: getattr(args, k) for k in DELTA_ARGS}, model=self.client.model_id)
 
     def metadata_retrieval(self, table):
         """
@@ -24,9 +111,7 @@ class UniDM_DataImputation(UniDM):
         columns = table.columns
         attributes = ["%s(id:%s)"%(c,i) for i,c in enumerate(columns) if c != self.major_c and c != self.impute_col and c != 'label_str']
 
-        prompt_rm = "The task is data imputation. The target query is '%s'.\n" % self.impute_col
-        prompt_rm += "The attributes about '%s' are %s.\n"%(self.dataset_name, attributes)
-        prompt_rm += "Which attribute is the most helpful for task and query?\nGive me ID only: "
+        prompt_rm = METADATA_PROMPT.render(column=self.impute_col, dataset=self.dataset_name, attributes=str(attributes))
         gen_text = self.apply_prompt(prompt=prompt_rm)
 
         output = list(filter(None, gen_text.split(' ')))[0]
@@ -36,49 +121,95 @@ class UniDM_DataImputation(UniDM):
     def instance_retrieval(self, candidates, target_Q, i, column_map):
         """
         The Instance-wise component of the auto-retrieve module.
+        :return: The top `instance_num` candidates and the scores of all candidates.
         """
+        instances = self.serialize_instances(candidates, column_map)
+
         if len(self.load_score_table) != 0:
-            table = candidates.copy()
-            table["score"] = self.load_score_table[i]
-            table.sort_values(by=["score"],axis=0,ascending=False,inplace=True)
-            table.reset_index(drop=True,inplace=True)
-            table = table.drop('score',axis=1)
-            retrieved_table = table.iloc[:self.instance_num]
-            return retrieved_table
+            # Positional scores cannot be checked against the candidates, so they are
+            # used for this run only and never written to the content-addressed store
+            score = [int(s) for s in self.load_score_table[i]]
+        else:
+            if self.score_batch_size > 1:
+                template = BATCH_SCORE_PROMPT.text + BATCH_SCORE_ITEM_PROMPT.text
+            else:
+                template = SCORE_PROMPT.text
+            # Keyed by the backend's model id: `--engine` alone does not tell a stub or mock from a real model
+            keys = [ScoreStore.key(target_Q, ins, template, self.client.model_id) for ins in instances]
+            # Only candidates never scored against this query cost an LLM call
+            stored = self.score_store.get_many(keys)
+            missing = [j for j, k in enumerate(keys) if k not in stored]
+            missing_instances = [instances[j] for j in missing]
+            if self.score_batch_size > 1:
+                new_score = self.batch_relevance_scoring(missing_instances, target_Q)
+            else:
+                new_score = self.relevance_scoring(missing_instances, target_Q)
+            stored.update({keys[j]: s for j, s in zip(missing, new_score)})
+            self.score_store.put_many({keys[j]: s for j, s in zip(missing, new_score)})
+            score = [stored[k] for k in keys]
 
-        score = []
-        prompt_ri_prefix = """The task is data imputation.\nThe target query is '%s'.\n"""%(target_Q)
-        for _, instance in candidates.iterrows():
+        table = candidates.copy()
+        table["score"] = score 
+        table.sort_values(by=["score"],axis=0,ascending=False,inplace=True)
+        table.reset_index(drop=True,inplace=True)
+        table = table.drop('score',axis=1)
+        retrieved_table = table.iloc[:self.instance_num]
+        return retrieved_table, score
 
-            ins_serialized = serialize_row(instance, column_map) + ". %s:%s" % (self.impute_col, instance[self.impute_col])
+    def serialize_instances(self, candidates, column_map):
+        """
+        Candidate rows with their value of the imputed column, as shown to the scoring prompts.
+        """
+        return [
+            ins_serialized + ". %s:%s" % (self.impute_col, value)
+            for ins_serialized, value in zip(serialize_frame(candidates, column_map), candidates[self.impute_col])
+        ]
 
-            prompt_ri = prompt_ri_prefix + """The give instance is '%s'\n"""%(ins_serialized)
-            prompt_ri += """Score the relevance of give instance to target query.\n"""
-            prompt_ri += """Use the following scoring system:\n0 - Not relevant at all\n1 - Slightly relevant \n2 - Moderately relevant\n3 - Highly relevant\n\n"""
-            prompt_ri += """(0/1/2/3):"""
+    def relevance_scoring(self, instances, target_Q):
+        """
+        Score each serialized instance against the target query with its own prompt.
+        """
+        prompts = [SCORE_PROMPT.render(target=target_Q, instance=ins_serialized) for ins_serialized in instances]
 
-            gen_text = self.apply_prompt(prompt=prompt_ri)
+        # Candidates are scored independently, so all requests go out at once
+        score = []
+        for gen_text in self.apply_prompts(prompts):
             output = list(filter(None,gen_text.split('\n')))[0]
             score.append(int(output))
+        return score
 
-        self.score_table.append(score)
+    def batch_relevance_scoring(self, instances, target_Q):
+        """
+        Score `score_batch_size` instances per prompt. Instances whose score cannot
+        be parsed from the reply are re-scored one by one.
+        """
+        prompts, batches = [], []
+        for start in range(0, len(instances), self.score_batch_size):
+            batch = instances[start:start + self.score_batch_size]
+            items = "".join(BATCH_SCORE_ITEM_PROMPT.render(num=str(j + 1), instance=ins) for j, ins in enumerate(batch))
+            prompts.append(BATCH_SCORE_PROMPT.render(target=target_Q, instances=items, num=str(len(batch))))
+            batches.append(batch)
 
-        table = candidates.copy()
-        table["score"] = score 
-        table.sort_values(by=["score"],axis=0,ascending=False,inplace=True)
-        table.reset_index(drop=True,inplace=True)
-        table = table.drop('score',axis=1)
-        retrieved_table = table.iloc[:self.instance_num]
-        return retrieved_table
+        score = []
+        for gen_text, batch in zip(self.apply_prompts(prompts), batches):
+            score.extend(parse_batch_scores(gen_text, len(batch)))
+
+        missing = [j for j, s in enumerate(score) if s is None]
+        if missing:
+            self.logger.info(f"Batched scoring: {len(missing)}/{len(score)} scores unparsed, scoring them one by one")
+            for j, s in zip(missing, self.relevance_scoring([instances[j] for j in missing], target_Q)):
+                score[j] = s
+        return score
 
     def data_parsing(self, context):
         """
         Adaptive data parsing module.
+        :param context: The serialized context lines, parsed concurrently.
         """
-        prompt = self.prompt_dp % context
-        gen_text = self.apply_prompt(prompt=prompt)
+        prompts = [self.prompt_dp.render(items=c) for c in context]
+        gen_texts = self.apply_prompts(prompts)
         # output = gen_text.strip('\n')
-        return gen_text
+        return gen_texts
 
     def prompt_engineering(self, context, target):
         """
@@ -86,93 +217,297 @@ class UniDM_DataImputation(UniDM):
         :param context: The context lines.
         :param target: The target line.
         """
-        if self.dataset_name == "Restaurant":
-            prompt_cq = "Write the claim as a clozen question.\n\nClaim:\nThe context is Wenham, Marysville, and Westmont are cities in the United States, identified by the ISO3 code USA. The target is city: New Cassel iso3: USA country: __\nCloze question:\nWenham, Marysville, and Westmont are cities in the United States, identified by the ISO3 code USA.\nNew Cassel is the name of a city whose ISO3 country code is USA. New Kassel belongs to the country __.\n\n" 
-        else:
-            prompt_cq = "Write the claim as a clozen question.\n\nClaim:\nThe context is The Griffin Protective Wave Case for Smart Phone - 8227-IP2WVB is a black case designed for the iPhone 3G, manufactured by Griffin. The target is name: Panasonic KX-TCA86 Headset description: Over-the-head manufacturer: __\nClozen question:\nThe manufacturer is __. [Pure Digital Technol,LG Electronics,ELGATO SYSTEMS,Samsung,Monster]\nThe Griffin Protective Wave Case for Smart Phone - 8227-IP2WVB is a black case designed for the iPhone 3G. The manufacturer is __.[Griffin]\nThe Panasonic KX-TCA86 Headset is an over-the-head headset. The manufacturer is __.[]\n\n" 
-
-        prompt_cq += "Claim:\n"
-        prompt_cq += "The context is %s "%context
-        prompt_cq += "The target is %s\n"%target
-        prompt_cq += "Cloze question:\n"
+        template = RESTAURANT_CLOZE_PROMPT if self.dataset_name == "Restaurant" else PRODUCT_CLOZE_PROMPT
+        prompt_cq = template.render(context=context, target=target)
 
         # print(prompt)
         gen_text = self.apply_prompt(prompt=prompt_cq)
         output = gen_text.strip('\n')
         return output
 
-    def run(self, train_data, test_data):
+    def group_rows(self, texts):
         """
-        :param train_data: The dataset to get the context.
-        :param test_data: The dataset to test.
+        Greedy groups of up to `group_size` similar rows: in input order, each row not yet grouped
+        leads a group with its most similar ungrouped rows.
+        :return: Lists of row positions, leader first.
+        """
+        index = NGramIndex().fit(list(texts))
+        free = np.ones(len(texts), dtype=bool)
+        groups = []
+        for i, text in enumerate(texts):
+            if not free[i]:
+                continue
+            free[i] = False
+            k = min(self.group_size - 1, int(free.sum()))
+            members = []
+            if k > 0:
+                scores = np.where(free, index.scores(text), -np.inf)
+                top = np.argpartition(-scores, k - 1)[:k]
+                members = sorted(int(j) for j in top)
+                free[members] = False
+            groups.append([i] + members)
+        return groups
+
+    def plan_groups(self, rows, texts, train_data):
+        """
+        Give every row its group's candidate pool and query, drawing one pool per group in group order.
         """
+        for g, members in enumerate(self.group_rows(texts)):
+            leader = members[0]
+            if self.index is not None:
+                nearest, _ = self.index.query(texts[leader], self.pre_rank)
+                candidates = train_data.iloc[nearest]
+            else:
+                candidates = train_data.sample(self.pool_size, random_state=self.rng)
+            for j in members:
+                rows[j].update(candidates=candidates, group=g, group_query=rows[leader]["target_Q"])
 
+    def group_retrieval_stage(self, group):
+        group["retrieved"], group["score"] = self.instance_retrieval(
+            group["candidates"], group["query"], group["id"], self.column_map
+        )
+        return group
+
+    def score_groups(self, rows):
+        """
+        Score each group's pool once against its leader's query, for the groups with rows left to run.
+        """
+        groups = {}
+        for r in self.pending(rows):
+            group = groups.setdefault(r["group"], {
+                "id": "group-%d" % r["group"], "query": r["group_query"], "candidates": r["candidates"], "rows": []
+            })
+            group["rows"].append(r)
+        RowPipeline([("instance_retrieval", self.group_retrieval_stage)], num_workers=self.row_workers).run(list(groups.values()))
+        self.telemetry.finish_rows(g["id"] for g in groups.values())
+        for group in groups.values():
+            for r in group["rows"]:
+                r["retrieved"], r["score"] = group["retrieved"], group["score"]
+
+        num_rows = sum(len(g["rows"]) for g in groups.values())
+        self.group_stats["groups"] += len(groups)
+        self.group_stats["rows"] += num_rows
+        self.group_stats["scoring_queries_saved"] += num_rows - len(groups)
+        # Calls the other rows of each group would have made to score the pool themselves
+        self.group_stats["scoring_calls_saved"] += sum(
+            (len(g["rows"]) - 1) * math.ceil(len(g["candidates"]) / self.score_batch_size) for g in groups.values()
+        )
+        self.logger.info(f"Grouped retrieval: {num_rows} rows share {len(groups)} scored pools")
+
+    def retrieval_stage(self, state):
+        # Instance-wise retrieve
+        if "retrieved" in state:
+            # Ranked once for the whole group
+            retrieved_table = state["retrieved"]
+        elif self.instance_wise and self.pre_rank_only:
+            # Candidates arrive in lexical order, which stands in for the LLM scores
+            retrieved_table = state["candidates"].iloc[:self.instance_num]
+        elif self.instance_wise:
+            retrieved_table, state["score"] = self.instance_retrieval(
+                state["candidates"], state["target_Q"], state["id"], self.column_map
+            )
+        else:
+            retrieved_table = state["candidates"]
+        context = serialize_frame(retrieved_table, self.column_map)
+        state["context"] = list(context)
+        return state
+
+    def parsing_stage(self, state):
+        # Parse data into a natural text representation
+        if self.Data_Parsing:
+            state["context"] = self.data_parsing(state["context"])
+        state["context"] = ' '.join(state["context"])
+        return state
+
+    def prompt_engineering_stage(self, state):
+        # Recursively uses the LLM to transform data tasks to the effective format
+        context, target_Q = state["context"], state["target_Q"]
+        if self.Prompt_Engineering:
+            prompt_as = CLOZE_ANSWER_PROMPT.ref(question=self.prompt_engineering(context, target_Q))
+        else:
+            if self.Data_Parsing:
+                prompt_as = PARSED_ANSWER_PROMPT.ref(context=context, target=target_Q)
+            else:
+                prompt_as = ANSWER_PROMPT.ref(context=context, target=target_Q)
+        state["prompt_as"] = prompt_as
+        return state
+
+    def answer_stage(self, state):
+        gen_text = self.apply_prompt(prompt=state["prompt_as"])
+        pred = list(filter(None,gen_text.split('\n')))[0]
+        pred = pred.strip('\n')
+        self.logger.info("ID: {} => Prediction: {}. Ground truth: {}. \n".format(state["id"], pred, state["label"].strip()))
+        state["pred"] = pred
+        return state
+
+    def rule_tier(self, state):
+        """
+        Exactly one known value of the imputed column appears in the row's own text.
+        """
+        tokens = normalize_text(state["text"]).split()
+        max_n = max((len(v.split()) for v in self.value_vocab), default=0)
+        matches = {
+            " ".join(tokens[s:s + n])
+            for n in range(1, max_n + 1) for s in range(len(tokens) - n + 1)
+        }
+        matches = [m for m in matches if m in self.value_vocab]
+        # "sony" inside "sony ericsson" is the same mention
+        matches = [m for m in matches if not any(m != o and f" {m} " in f" {o} " for o in matches)]
+        if len(matches) != 1:
+            return None
+        return self.value_vocab[matches[0]], 1.0
+
+    def lexical_tier(self, state):
+        """
+        Similarity-weighted vote of the nearest train rows; confident when the nearest row is close and agrees.
+        """
+        nearest, sims = self.cascade_index.query(state["text"], 5)
+        votes = {}
+        for j, sim in zip(nearest, sims):
+            label = self.train_labels[j]
+            if label and label.lower() != "nan":
+                votes[label] = votes.get(label, 0.0) + float(sim)
+        total = float(sims.sum())
+        if not votes or total <= 0:
+            return None
+        label = max(votes, key=votes.get)
+        return label, float(sims[0]) * votes[label] / total
+
+    def logprob_tier(self, state):
+        """
+        One short direct question, trusted by the probability of its answer.
+        """
+        prompt = LOGPROB_PROMPT.render(target=state["target_Q"], column=self.impute_col)
+        gen_text, prob = self.apply_prompt_with_confidence(prompt)
+        lines = list(filter(None, gen_text.split('\n')))
+        if prob is None or not lines:
+            return None
+        return lines[0], prob
+
+    def cascade_tiers(self):
+        return [("rules", self.rule_tier), ("lexical", self.lexical_tier), ("logprob", self.logprob_tier)]
+
+    def reuse_unchanged(self, rows):
+        """
+        Fingerprint every pending row and fill in the stored prediction of rows seen unchanged before.
+        :param rows: Planned row state dicts, updated in place.
+        """
+        config = dict(self.delta_config, column_map=self.column_map)
+        start, end = self.shard_bounds(len(rows))
+        # Rows finished in the checkpoint are fingerprinted too, so they get stored at the end
+        for r in rows[start:end]:
+            # Grouped rows are ranked by their group's query
+            target = r["target_Q"] if "group_query" not in r else r["target_Q"] + "\x1f" + r["group_query"]
+            r["fingerprint"] = DeltaStore.key(config, target, self.serialize_instances(r["candidates"], self.column_map))
+        todo = self.pending(rows)
+        stored = self.delta_store.get_many([r["fingerprint"] for r in todo])
+        for r in todo:
+            if r["fingerprint"] in stored:
+                r.update(stored[r["fingerprint"]], tier="delta")
+        self.logger.info(f"Delta: reused {sum(1 for r in todo if r['fingerprint'] in stored)}/{len(todo)} unchanged rows")
+
+    def close(self):
+        super().close()
+        self.score_store.close()
+        if self.delta_store is not None:
+            self.delta_store.close()
+
+    def prepare(self, train_data):
+        """
+        Pick the serialized columns and build the pre-rank index.
+        :param train_data: The dataset to get the context.
+        """
         self.major_c = train_data.columns[0]
 
         # Metadata-wise retrieve
         if self.metadata_wise:
             column_map = {self.major_c:self.major_c}
-            metadata_c_idx = self.metadata_retrieval(train_data)
+            with scope("metadata_retrieval"):
+                metadata_c_idx = self.metadata_retrieval(train_data)
             metadata_c = train_data.columns[metadata_c_idx]
             column_map[metadata_c] = metadata_c
         else:
             column_map = {c: c for c in train_data.columns if c != "id" and c != self.impute_col and c != 'label_str'}
 
-        # Load instance-retrieval result if exists
-        score_table_name = "ret_score/dataset%s_candidate%d_ins%d.npy" % (self.dataset_name, self.context_num, self.instance_num)
-        if os.path.exists(score_table_name):
-            self.load_score_table = np.load(score_table_name)
+        if self.instance_wise and self.pre_rank > 0:
+            train_serialized = serialize_frame(train_data, column_map)
+            self.index = NGramIndex().fit(list(train_serialized))
+
+        if self.cascade:
+            self.train_labels = train_data['label_str'].astype(str).str.strip().to_numpy()
+            self.value_vocab = {normalize_text(v): v for v in self.train_labels if v and v.lower() != "nan"}
+            # Values spelled like a column name would match every serialized row
+            for c in column_map:
+                self.value_vocab.pop(normalize_text(c), None)
+            self.value_vocab.pop("", None)
+            self.cascade_index = self.index or NGramIndex().fit(list(serialize_frame(train_data, column_map)))
+
+        self.column_map = column_map
+        self.prepared = True
+
+    def run(self, train_data, test_data):
+        """
+        :param train_data: The dataset to get the context.
+        :param test_data: The dataset to test.
+        """
+        if not self.prepared:
+            self.prepare(train_data)
+        column_map = self.column_map
 
-        # 
-        preds = []
-        for i,row in test_data.iterrows():
+        # Draw every row's examples up front and in input order, so the
+        # predictions do not depend on how many rows run concurrently
+        rows = []
+        sample_num = self.context_num if self.instance_wise else self.instance_num
+        test_serialized = serialize_frame(test_data, column_map)
+        for i, row_serialized, label in zip(test_data.index, test_serialized, test_data['label_str']):
             # Query 
-            row_serialized = serialize_row(row, column_map)
             target_Q = row_serialized + ". " + "%s: __" % self.impute_col
-
-            # Instance-wise retrieve
-            if self.instance_wise:
-                instance_candidate = train_data.sample(self.context_num)
-                retrieved_table = self.instance_retrieval(instance_candidate, target_Q, i, column_map)
-                context = retrieved_table.apply(
-                    lambda row: serialize_row(row,column_map),
-                    axis=1,
-                )
+            if self.grouped:
+                # Drawn per group below
+                candidates = None
+            elif self.index is not None:
+                nearest, _ = self.index.query(row_serialized, self.pre_rank)
+                candidates = train_data.iloc[nearest]
+            elif self.delta_store is not None:
+                # Seeded by the row itself, so inserted or deleted rows do not reshuffle the others' pools
+                digest = hashlib.sha256(f"{self.seed}\x1f{row_serialized}".encode("utf-8")).hexdigest()
+                candidates = train_data.sample(sample_num, random_state=np.random.RandomState(int(digest[:8], 16)))
             else:
-                random_instances = train_data.sample(self.instance_num)
-                context = random_instances.apply(
-                    lambda row: serialize_row(row,column_map),
-                    axis=1,
-                )
-            
-            # Parse data into a natural text representation
-            context = list(context)
-            if self.Data_Parsing:
-                context = [self.data_parsing(c) for c in context]
-            context = ' '.join(context)
+                candidates = train_data.sample(sample_num, random_state=self.rng)
+            rows.append({"id": i, "label": label, "text": row_serialized, "target_Q": target_Q, "candidates": candidates})
+        if self.grouped:
+            self.plan_groups(rows, list(test_serialized), train_data)
+        if self.delta_store is not None:
+            self.reuse_unchanged(rows)
+        self.early_exit(rows)
+        if self.grouped:
+            self.score_groups(rows)
 
-            # Recursively uses the LLM to transform data tasks to the effective format
-            if self.Prompt_Engineering:
-                prompt_as = self.prompt_engineering(context, target_Q)
-                prompt_as += "\nAnswer:"
-            else:
-                if self.Data_Parsing:
-                    prompt_as = context + "\n" + target_Q + "\nAnswer:"
-                else:
-                    prompt_as = "Follow the example to impute the missing value.\n" + context + target_Q +"\nAnswer:"
-
-            gen_text = self.apply_prompt(prompt=prompt_as)
-            pred = list(filter(None,gen_text.split('\n')))[0]
-            pred = pred.strip('\n')
-            self.logger.info("ID: {} => Prediction: {}. Ground truth: {}. \n".format(i, pred, row['label_str'].strip()))
-            
-            preds.append(pred)
-            self.p_as.append(prompt_as)
-
-        # Save the score table
-        if self.instance_wise:
-            if not os.path.exists(score_table_name):
-                np.save(score_table_name, np.array(self.score_table))
+        stages = [
+            ("instance_retrieval", self.retrieval_stage),
+            ("data_parsing", self.parsing_stage),
+            ("prompt_engineering", self.prompt_engineering_stage),
+            ("answer", self.answer_stage),
+        ]
+        results = self.run_rows(rows, stages)
+        if self.delta_store is not None:
+            start, end = self.shard_bounds(len(rows))
+            self.delta_store.put_many({
+                row["fingerprint"]: r for row, r in zip(rows[start:end], results)
+                if "fingerprint" in row and r.get("tier") != "delta"
+            })
+
+        preds = [r["pred"] for r in results]
+        self.p_as.extend(r["prompt_as"] for r in results)
+        if self.instance_wise and not self.pre_rank_only:
+            # Rows answered by a cascade tier were never scored
+            self.score_table.extend(r.get("score") for r in results)
+
+        if self.instance_wise and not self.pre_rank_only:
+            self.logger.info(
+                f"Score store {self.score_store.path}: {self.score_store.hits} scores reused, "
+                f"{self.score_store.misses} scored"
+            )
 
         return preds
 
@@ -1,29 +1,52 @@
 #!/usr/bin/env python
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
 from model.unidm_base import UniDM
+from utils.pipeline import RowPipeline
+from utils.templates import Template
+
+PATTERN_PROMPT = Template("dt.pattern", "Summarize transformation pattern from text.\n\n{context}\nTransformation pattern is:")
+TASK_PROMPT = Template("dt.task", "Extract the specific transformation task from the text.\n\n{task}\nTransformation task is:")
+FINAL_PATTERN_PROMPT = Template(
+    "dt.final_pattern",
+    "Please summarize the final transformation pattern used for the given example based on the two patterns.\n"
+    "Pattern 1: {pattern_1}\nPattern 2: {pattern_2}\nExample:\n{context}"
+    "The final correct transformation pattern is: ",
+)
+CLAIM_PROMPT = Template(
+    "dt.prompt_engineering",
+    "Write the claim as target text.\nClaim:\nThe context is\ndata before tansformation: 20000101\ndata after tansformation: 2000-01-01\ndata before tansformation: 20231220\ndata after tansformation: 2023-12-20\nThe target query is\ndata before tansformation: 19990415\ndata after tansformation: \nTarget text:\n20000101 to 2000-01-01\n20231220 to 2023-12-20\n19990415 to \n\n"
+    "Claim:\nThe context is\n{context}\nThe target query is\n{target}\nTarget text:\n",
+)
+QUERY_PROMPT = Template("dt.query", "data before tansformation: {input}\ndata after tansformation: ")
+ANSWER_PROMPT = Template("dt.answer", "{instruction}\n\n{context}{target}")
+CLAIM_ANSWER_PROMPT = Template("dt.answer.claim", "{instruction}\n\n{target_text}")
 
 
 class UniDM_DataTransformation(UniDM):
-    def __init__(self, args, logger):
-        super().__init__(args, logger)
-        self.manifest.stop_token = '\n\n'
+    task = "data_transformation"
+
+    def __init__(self, args, logger, prompt_cache=None):
+        super().__init__(args, logger, prompt_cache)
+        self.stop_token = '\n\n'
         self.dataset_name = args.data_dir.split('/')[-1]
         self.pe_suffix = "Follow the example to transform the data:\n"
+        # Parsed transformation pattern per (instruction, context) group
+        self.pattern_cache = {}
 
     def data_parsing(self, task, context):
-        prompt = "Summarize transformation pattern from text.\n\n"
-        prompt += context + "\nTransformation pattern is:"
-        gen_text = self.apply_prompt(prompt=prompt)
-        pattern_1 = gen_text.strip('\n')
-        
-        prompt = "Extract the specific transformation task from the text.\n\n"
-        prompt += task + "\nTransformation task is:"
-        gen_text = self.apply_prompt(prompt=prompt)
-        pattern_2 = gen_text.strip('\n')
+        """
+        Adaptive data parsing module.
+        :param task: The instruction of the benchmark file.
+        :param context: The serialized examples of the benchmark file.
+        """
+        prompt_1 = PATTERN_PROMPT.render(context=context)
+        prompt_2 = TASK_PROMPT.render(task=task)
+
+        # The two patterns are independent, so ask for both at once
+        gen_texts = self.apply_prompts([prompt_1, prompt_2])
+        pattern_1, pattern_2 = [gen_text.strip('\n') for gen_text in gen_texts]
 
-        prompt = "Please summarize the final transformation pattern used for the given example based on the two patterns.\n"
-        prompt += "Pattern 1: %s\nPattern 2: %s\nExample:\n%s"%(pattern_1,pattern_2,context)
-        prompt += "The final correct transformation pattern is: "
+        prompt = FINAL_PATTERN_PROMPT.render(pattern_1=pattern_1, pattern_2=pattern_2, context=context)
         gen_text = self.apply_prompt(prompt=prompt)
         output = gen_text.strip('\n')
         output = output.strip(' ')
@@ -35,41 +58,67 @@ class UniDM_DataTransformation(UniDM):
         :param context: The context lines.
         :param target: The target line.
         """
-        prompt = "Write the claim as target text.\nClaim:\nThe context is\ndata before tansformation: 20000101\ndata after tansformation: 2000-01-01\ndata before tansformation: 20231220\ndata after tansformation: 2023-12-20\nThe target query is\ndata before tansformation: 19990415\ndata after tansformation: \nTarget text:\n20000101 to 2000-01-01\n20231220 to 2023-12-20\n19990415 to \n\n"
-        prompt += "Claim:\n" 
-        prompt += "The context is\n%s\n"%context.strip('\n')
-        prompt += "The target query is\n%s\n"%target
-        prompt += "Target text:\n"
+        prompt = CLAIM_PROMPT.render(context=context.strip('\n'), target=target)
         gen_text = self.apply_prompt(prompt=prompt)
         output = gen_text.strip('\n')
         return output
 
-    def run(self, train_data, test_data):
-        preds = []
+    def pattern_stage(self, group):
+        instruction, context = group["key"]
+        group["pattern"] = self.data_parsing(instruction, context)
+        return group
+
+    def parsing_stage(self, state):
+        row = state["row"]
+        state["target_Q"] = QUERY_PROMPT.render(input=str(row['input']))
+
+        # Parse data into a natural text representation
+        if self.Data_Parsing:
+            state["instruction"] = self.pattern_cache[(row['instruction'], row['context'])]
+        else:
+            state["instruction"] = row['instruction']
+        return state
 
-        for i,row in test_data.iterrows():
-            target_Q =  f"data before tansformation: {row['input']}\ndata after tansformation: "
+    def prompt_engineering_stage(self, state):
+        row, target_Q = state["row"], state["target_Q"]
+        # Recursively uses the LLM to transform data tasks to the effective format
+        if self.Prompt_Engineering:
+            target_text = self.prompt_engineering(row['context'], target_Q)
+            prompt_as = CLAIM_ANSWER_PROMPT.ref(instruction=state["instruction"], target_text=target_text)
+        else:
+            prompt_as = ANSWER_PROMPT.ref(instruction=state["instruction"], context=row['context'], target=target_Q)
 
-            # Parse data into a natural text representation
-            if self.Data_Parsing:
-                instruction = self.data_parsing(row['instruction'], row['context'])
-            else:
-                instruction = row['instruction']
+        state["prompt_as"] = prompt_as
+        return state
 
-            # Recursively uses the LLM to transform data tasks to the effective format
-            if self.Prompt_Engineering:
-                prompt_as = self.prompt_engineering(row['context'], target_Q)
-            else:
-                prompt_as = row['context'] + target_Q
+    def answer_stage(self, state):
+        gen_text = self.apply_prompt(prompt=state["prompt_as"])
+        pred = list(filter(None,gen_text.split('\n')))[0]
+
+        self.logger.info("ID: {} => Prediction: {}. Ground truth: {}. \n".format(state["id"], pred, state["row"]['label_str'].strip()))
+        state["pred"] = pred
+        return state
+
+    def run(self, train_data, test_data):
+        rows = [{"id": i, "label": row['label_str'], "row": row} for i,row in test_data.iterrows()]
 
-            prompt_as = instruction + "\n\n" + prompt_as
-        
-            gen_text = self.apply_prompt(prompt=prompt_as)
-            pred = list(filter(None,gen_text.split('\n')))[0]
+        # Every test row of a benchmark file shares its instruction and examples, so the
+        # transformation pattern is summarized once per file, files in parallel
+        if self.Data_Parsing:
+            keys = dict.fromkeys((r["row"]['instruction'], r["row"]['context']) for r in self.pending(rows))
+            groups = [{"key": key} for key in keys if key not in self.pattern_cache]
+            pipeline = RowPipeline([("data_parsing", self.pattern_stage)], num_workers=self.row_workers)
+            for group in pipeline.run(groups):
+                self.pattern_cache[group["key"]] = group["pattern"]
+            self.logger.info(f"Summarized {len(groups)} transformation patterns for {len(rows)} rows")
 
-            self.logger.info("ID: {} => Prediction: {}. Ground truth: {}. \n".format(i, pred, row['label_str'].strip()))
-            
-            preds.append(pred)
-            self.p_as.append(prompt_as)
+        stages = [
+            ("data_parsing", self.parsing_stage),
+            ("prompt_engineering", self.prompt_engineering_stage),
+            ("answer", self.answer_stage),
+        ]
+        results = self.run_rows(rows, stages)
 
+        preds = [r["pred"] for r in results]
+        self.p_as.extend(r["prompt_as"] for r in results)
         return preds
@@ -1,20 +1,58 @@
 #!/usr/bin/env python
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import threading
 import pandas as pd
 
 from model.unidm_base import UniDM
 from utils.constants import MATCH_PROD_NAME
+from utils.pipeline import RowPipeline
+from utils.retrieval import NGramIndex, normalize_text
+from utils.telemetry import scope
+from utils.templates import Template, parse_indexed_reply
+
+
+def parse_batch_answers(gen_text, num):
+    """
+    Parse a "[1] Yes [2] No ..." reply into `num` answers (" Yes"/" No"), None for items that are neither.
+    """
+    return parse_indexed_reply(gen_text, num, lambda v: " " + v.capitalize() if v.lower() in ("yes", "no") else None)
 
 
 class UniDM_EntityResolution(UniDM):
-    def __init__(self, args, logger):
-        super().__init__(args, logger)
+    task = "entity_resolution"
+
+    def __init__(self, args, logger, prompt_cache=None):
+        super().__init__(args, logger, prompt_cache)
         self.dataset_name = args.data_dir.split('/')[-1]
-        prod_name = MATCH_PROD_NAME[dataset_name]
-        self.prompt_dp = f"Given the items and convert the them into a textual format in a logical order.\n The items are %s.\n The {prod_name} is "
+        prod_name = MATCH_PROD_NAME[self.dataset_name]
         self.pe_suffix = f"Do {prod_name} A and {prod_name} B describe the same entity? Yes or No. "
-        self.template = f"The {prod_name} A is %s The {prod_name} B is %s"
+        # Templates are named per product name, the only part that differs between datasets
+        pair = f"The {prod_name} A is {{entity_A}} The {prod_name} B is {{entity_B}}"
+        self.prompt_dp = Template(
+            f"er.data_parsing.{prod_name}",
+            f"Given the items and convert the them into a textual format in a logical order.\n The items are {{items}}.\n The {prod_name} is ",
+        )
+        self.question_prompt = Template(f"er.question.{prod_name}", pair + self.pe_suffix)
+        self.example_prompt = Template(f"er.example.{prod_name}", pair + self.pe_suffix + " {label}")
+        # The context is the same for every pair; keep it a separate, leading segment
+        self.answer_prompt = Template(f"er.answer.{prod_name}", "{context}" + pair + self.pe_suffix, prefix="context")
+        self.batch_item_prompt = Template(f"er.batch_item.{prod_name}", "[{num}] " + pair + self.pe_suffix.strip() + "\n")
+        self.batch_answer_prompt = Template(
+            f"er.batch.{prod_name}",
+            "{context}Answer each of the following {num} questions.\n{questions}"
+            "Answer in one line as [id] Yes/No for all {num} questions, e.g. [1] Yes [2] No\nAnswers:",
+            prefix="context",
+        )
         self.context = ""
+        # Test pairs answered per prompt, under one copy of the shared context
+        self.question_batch_size = args.question_batch_size
+        self.batch_answers = {}
+        # Parsed entities keyed by (table side, serialized entity, parsing template)
+        self.parse_cache = {}
+        self.parse_hits, self.parse_misses = 0, 0
+        self._parse_lock = threading.Lock()
+        # Cascade: IDF statistics of the train entities for the lexical tier
+        self.cascade_index = None
 
     def instance_retrieval(self, train):
         """
@@ -23,14 +61,19 @@ class UniDM_EntityResolution(UniDM):
         # data balance
         labels = train['label_str'].unique()
         instances = [train['label_str'] == l for l in labels]
-        instances = pd.concat([ins.sample(self.context_num) for ins in instances])
-        instances = train.sample(self.instance_num)
+        instances = pd.concat([ins.sample(self.context_num, random_state=self.rng) for ins in instances])
+        instances = train.sample(self.instance_num, random_state=self.rng)
+
+        # Parse every example entity in one concurrent batch
+        entities = self.parse_entities(
+            [("A", e) for e in instances["serialized_A"]] + [("B", e) for e in instances["serialized_B"]]
+        )
+        entities_A, entities_B = entities[:len(instances)], entities[len(instances):]
 
         context = ""
-        for i,row in instances.iterrows():
-            entity_A, entity_B = self.data_parsing(row["serialized_A"]), self.data_parsing(row["serialized_B"])
-            pre, gt = self.pe_suffix, row["label_str"].strip()
-            context_r = self.template % (entity_A, entity_B) + f"{pre} {gt}"
+        for (i,row), entity_A, entity_B in zip(instances.iterrows(), entities_A, entities_B):
+            gt = row["label_str"].strip()
+            context_r = self.example_prompt.render(entity_A=entity_A, entity_B=entity_B, label=gt)
 
             context += context_r + "\n\n"
         self.context = context
@@ -38,12 +81,29 @@ class UniDM_EntityResolution(UniDM):
     def data_parsing(self, context):
         """
         Adaptive data parsing module.
+        :param context: The serialized entities, parsed concurrently.
         """
-        prompt = self.prompt_dp % context
-        gen_text = self.apply_prompt(prompt=prompt)
+        prompts = [self.prompt_dp.render(items=c) for c in context]
+        gen_texts = self.apply_prompts(prompts)
         # output = gen_text.strip('\n')
-        # time.sleep(TIMESLEEP)
-        return gen_text
+        return gen_texts
+
+    def parse_entities(self, entities):
+        """
+        Memoized data parsing. Each distinct entity is parsed once, all misses in one concurrent batch.
+        :param entities: (table side, serialized entity) pairs.
+        :return: The parsed entities in input order.
+        """
+        keys = [(side, e, self.prompt_dp) for side, e in entities]
+        with self._parse_lock:
+            missing = list(dict.fromkeys(k for k in keys if k not in self.parse_cache))
+            self.parse_misses += len(missing)
+            self.parse_hits += len(keys) - len(missing)
+        if missing:
+            parsed = self.data_parsing([e for _, e, _ in missing])
+            with self._parse_lock:
+                self.parse_cache.update(zip(missing, parsed))
+        return [self.parse_cache[k] for k in keys]
 
     def prompt_engineering(self, target):
         """
@@ -51,30 +111,148 @@ class UniDM_EntityResolution(UniDM):
         :param target: The target row.
         """
         entity_A, entity_B = target
-        pre = self.pe_suffix
-        query = self.template % (entity_A, entity_B) + f"{pre}"
-        prompt_pe = self.context + query
+        prompt_pe = self.answer_prompt.ref(context=self.context, entity_A=entity_A, entity_B=entity_B)
         return prompt_pe
 
+    def batch_prompt(self, targets):
+        """
+        Several test pairs under one copy of the context, answered in one line.
+        :param targets: The parsed (entity A, entity B) pairs.
+        """
+        questions = "".join(
+            self.batch_item_prompt.render(num=str(j + 1), entity_A=entity_A, entity_B=entity_B)
+            for j, (entity_A, entity_B) in enumerate(targets)
+        )
+        return self.batch_answer_prompt.render(context=self.context, num=str(len(targets)), questions=questions)
+
+    def batch_answer_stage(self, batch):
+        """
+        Answer a batch of pairs with one prompt; pairs whose answer cannot be parsed are asked one by one.
+        """
+        prompt = self.batch_prompt(batch["targets"])
+        answers = parse_batch_answers(self.apply_prompt(prompt=prompt), len(batch["ids"]))
+        missing = [j for j, a in enumerate(answers) if a is None]
+        if missing:
+            self.logger.info(f"Batched questions: {len(missing)}/{len(answers)} answers unparsed, asking them one by one")
+            singles = [self.prompt_engineering(batch["targets"][j]) for j in missing]
+            for j, single, answer in zip(missing, singles, self.apply_prompts(singles)):
+                self.batch_answers[batch["ids"][j]] = (answer, single)
+        for row_id, answer in zip(batch["ids"], answers):
+            if answer is not None:
+                self.batch_answers[row_id] = (answer, prompt)
+        return batch
+
+    def parsing_stage(self, state):
+        row = state["row"]
+        state["entities"] = self.parse_entities([("A", row["serialized_A"]), ("B", row["serialized_B"])])
+        return state
+
+    def prompt_engineering_stage(self, state):
+        state["prompt_as"] = self.prompt_engineering(state["entities"])
+        return state
+
+    def answer_stage(self, state):
+        if state["id"] in self.batch_answers:
+            pred, state["prompt_as"] = self.batch_answers.pop(state["id"])
+        else:
+            pred = self.apply_prompt(prompt=state["prompt_as"])
+        gt = state["row"]["label_str"].strip()
+        self.logger.info(f"idx:{state['id']} ====> pred:{pred} / gt:{gt}")
+        state["pred"] = pred
+        return state
+
+    def rule_tier(self, state):
+        """
+        Both entities serialize to the same words.
+        """
+        row = state["row"]
+        if normalize_text(row["serialized_A"]) == normalize_text(row["serialized_B"]):
+            return " Yes", 1.0
+        return None
+
+    def lexical_tier(self, state):
+        """
+        TF-IDF cosine of the two serialized entities, confident when it is near either end.
+        """
+        row = state["row"]
+        sim = self.cascade_index.similarity(row["serialized_A"], row["serialized_B"])
+        return (" Yes", sim) if sim >= 0.5 else (" No", 1.0 - sim)
+
+    def logprob_tier(self, state):
+        """
+        The pair asked without examples, trusted by the probability of the answer.
+        """
+        row = state["row"]
+        prompt = self.question_prompt.render(entity_A=row["serialized_A"], entity_B=row["serialized_B"])
+        gen_text, prob = self.apply_prompt_with_confidence(prompt)
+        if prob is None:
+            return None
+        return gen_text, prob
+
+    def cascade_tiers(self):
+        return [("rules", self.rule_tier), ("lexical", self.lexical_tier), ("logprob", self.logprob_tier)]
+
+    def prepare(self, train_data):
+        """
+        Build the in-context examples.
+        :param train_data: The dataset to get the context.
+        """
+        if self.instance_wise:
+            with scope("instance_retrieval"):
+                self.instance_retrieval(train_data)
+        if self.cascade:
+            self.cascade_index = NGramIndex().fit(list(train_data["serialized_A"]) + list(train_data["serialized_B"]))
+        self.prepared = True
+
     def run(self, train_data, test_data):
         """
         :param train_data: The dataset to get the context.
         :param test_data: The dataset to test.
         """
-        if self.instance_wise:
-            self.instance_retrieval(train_data)
-
-        preds = []
-        for i,row in test_data.iterrows():
-            
-            entity_A, entity_B = self.data_parsing(row["serialized_A"]), self.data_parsing(row["serialized_B"])
-            prompt_pe = self.prompt_engineering([entity_A, entity_B])
-            self.p_as.append(prompt_pe)
-            pred = self.apply_prompt(prompt=prompt_pe)
-            
-            preds.append(pred)
-            gt = row["label_str"].strip()
-            self.logger.info(f"idx:{i} ====> pred:{pred} / gt:{gt}")
-        
+        if not self.prepared:
+            self.prepare(train_data)
+
+        rows = [{"id": i, "label": row["label_str"], "row": row} for i,row in test_data.iterrows()]
+        self.early_exit(rows)
+
+        # Blocked pairs repeat the same entities many times: parse every distinct
+        # entity of the rows still to run exactly once, up front
+        todo = [r["row"] for r in self.pending(rows)]
+        with scope("data_parsing"):
+            self.parse_entities(
+                [("A", row["serialized_A"]) for row in todo] + [("B", row["serialized_B"]) for row in todo]
+            )
+
+        # Batched questions are answered up front, in fixed groups of consecutive rows,
+        # so the grouping does not depend on how rows interleave
+        if self.question_batch_size > 1:
+            todo = self.pending(rows)
+            targets = [
+                (self.parse_cache[("A", r["row"]["serialized_A"], self.prompt_dp)],
+                 self.parse_cache[("B", r["row"]["serialized_B"], self.prompt_dp)])
+                for r in todo
+            ]
+            size = self.question_batch_size
+            batches = [
+                {"ids": [r["id"] for r in todo[start:start + size]], "targets": targets[start:start + size]}
+                for start in range(0, len(todo), size)
+            ]
+            RowPipeline([("answer", self.batch_answer_stage)], num_workers=self.row_workers).run(batches)
+            self.logger.info(f"Asked {len(todo)} questions in {len(batches)} batched prompts")
+
+        stages = [
+            ("data_parsing", self.parsing_stage),
+            ("prompt_engineering", self.prompt_engineering_stage),
+            ("answer", self.answer_stage),
+        ]
+        results = self.run_rows(rows, stages)
+
+        preds = [r["pred"] for r in results]
+        self.p_as.extend(r["prompt_as"] for r in results)
+
+        lookups = self.parse_hits + self.parse_misses
+        self.logger.info(
+            f"Entity parse cache: {self.parse_misses} distinct entities parsed for {lookups} lookups "
+            f"(hit rate {self.parse_hits / max(1, lookups):.1%})"
+        )
         return preds
-            
\ No newline at end of file
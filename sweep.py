@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Search the UniDM module switches for the best accuracy/cost trade-off on a dataset.
+
+    python sweep.py --task data_imputation --data_dir dataset/datasets/data_imputation/Buy --api_key <KEY>
+    python sweep.py --task entity_resolution --data_dir <DATA DIR> --space space.json --min_rows 30 --eta 3
+
+`space.json` maps `inference.py` flags to the values to try, e.g.
+    {"instance_wise": [false, true], "data_parsing": [false, true], "context_num": [10, 20]}
+Every configuration of the grid runs on a small subsample of the test rows;
+the best 1/eta of them (by Pareto rank of accuracy against LLM calls, tokens
+and wall time, then accuracy) go on to a subsample eta times larger, until at
+most eta are left; those run on --max_rows rows (successive halving), and the
+Pareto frontier of that last rung is reported in `sweep.json`. All runs share one
+prompt cache and score store, so configurations that share stages reuse each
+other's LLM outputs. Runs write the cache when they finish, so configurations
+that differ only in the last flag of the space (and share every stage before
+it) run one after another in the same process; list the flags of the space in
+pipeline order. Flags the sweep does not know are passed to every run.
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import inference
+from driver import _flags, _init_worker
+from utils.data_utils import read_data
+from utils.dispatch import SharedTokenBucket
+from utils.prompt_cache import PromptCache
+from utils.score_store import ScoreStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPACE = {
+    "instance_wise": [False, True],
+    "metadata_wise": [False, True],
+    "data_parsing": [False, True],
+    "prompt_engineering": [False, True],
+}
+# Objective -> True when higher is better
+OBJECTIVES = {"metric": True, "calls": False, "tokens": False, "seconds": False}
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Generate args; unknown flags are forwarded to every run."""
+    parser = argparse.ArgumentParser(description="Successive-halving sweep over UniDM configurations.")
+    parser.add_argument("--task", type=str, required=True, choices=["data_imputation", "data_transformation", "entity_resolution"])
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--space", type=str, help="JSON file mapping flags to the values to try.", default=None)
+    parser.add_argument("--output_dir", type=str, help="Where every run, the shared prompt cache and sweep.json go.", default="sweep")
+    parser.add_argument("--metric", type=str, choices=["acc", "f1", "prec", "rec"], help="Defaults to f1 for entity resolution, acc otherwise.", default=None)
+    parser.add_argument("--min_rows", type=int, help="Test rows of the first rung.", default=20)
+    parser.add_argument("--max_rows", type=int, help="Most test rows of any rung (0 for the whole test split).", default=0)
+    parser.add_argument("--eta", type=int, help="Keep 1/eta of the configurations per rung and grow the rows eta times.", default=3)
+    parser.add_argument("--processes", type=int, help="Runs in parallel.", default=multiprocessing.cpu_count())
+    parser.add_argument("--rpm", type=float, help="Requests per minute shared by all runs (0 disables).", default=3000)
+    parser.add_argument("--tpm", type=float, help="Tokens per minute shared by all runs (0 disables).", default=250000)
+    args, forwarded = parser.parse_known_args(argv)
+    if forwarded[:1] == ["--"]:
+        forwarded = forwarded[1:]
+    if args.eta < 2:
+        parser.error("--eta must be at least 2")
+    return args, forwarded
+
+
+def grid(space: Dict[str, List]) -> List[Dict]:
+    """Every combination of the values in `space`."""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def dominates(a: Dict, b: Dict) -> bool:
+    """`a` is no worse than `b` on every objective and better on at least one."""
+    no_worse = all(a[k] >= b[k] if up else a[k] <= b[k] for k, up in OBJECTIVES.items())
+    better = any(a[k] > b[k] if up else a[k] < b[k] for k, up in OBJECTIVES.items())
+    return no_worse and better
+
+
+def pareto_ranks(results: List[Dict]) -> List[int]:
+    """Non-dominated sorting: 0 for the Pareto frontier, 1 for the frontier of the rest, and so on."""
+    ranks = [None] * len(results)
+    rank, left = 0, set(range(len(results)))
+    while left:
+        front = {i for i in left if not any(dominates(results[j], results[i]) for j in left if j != i)}
+        for i in front:
+            ranks[i] = rank
+        left -= front
+        rank += 1
+    return ranks
+
+
+def promote(results: List[Dict], num: int) -> List[Dict]:
+    """The `num` best results by Pareto rank, then by metric, so cheap configurations survive next to accurate ones."""
+    ranks = pareto_ranks(results)
+    order = sorted(range(len(results)), key=lambda i: (ranks[i], -results[i]["metric"]))
+    return [results[i] for i in order[:num]]
+
+
+def schedule(num_configs: int, min_rows: int, max_rows: int, eta: int) -> List[int]:
+    """Test rows of every rung: eta times more per rung while more than eta configurations are left, then `max_rows`."""
+    rungs, rows = [], min(min_rows, max_rows)
+    while num_configs > eta and rows < max_rows:
+        rungs.append(rows)
+        num_configs = math.ceil(num_configs / eta)
+        rows = min(rows * eta, max_rows)
+    return rungs + [max_rows]
+
+
+def chains(configs: List[Dict]) -> List[List[int]]:
+    """Positions of the configurations grouped by every flag but the last, in order of first appearance."""
+    groups = {}
+    for i, config in enumerate(configs):
+        groups.setdefault(json.dumps(list(config.items())[:-1]), []).append(i)
+    return list(groups.values())
+
+
+def _run_config(argv: List[str]):
+    start = time.perf_counter()
+    try:
+        output_file = inference.main(argv)
+        return argv, str(output_file), time.perf_counter() - start, None
+    except Exception:
+        return argv, None, time.perf_counter() - start, traceback.format_exc()
+
+
+def _run_chain(argvs: List[List[str]]):
+    # One after another, so each run finds the prompt cache entries of the runs before it
+    return [_run_config(argv) for argv in argvs]
+
+
+def read_result(config: Dict, rows: int, output_file: Path, seconds: float, metric: str) -> Dict:
+    metrics = json.load(open(output_file.parent / "metrics.json"))
+    total = json.load(open(output_file.parent / "telemetry.json"))["total"]
+    return {
+        "config": config,
+        "rows": rows,
+        "metric": sum(metrics[metric]) / len(metrics[metric]),
+        # Calls and tokens count cache hits too: they are what the configuration costs on its own
+        "calls": total["calls"],
+        "tokens": total["prompt_tokens"] + total["completion_tokens"],
+        "seconds": seconds,
+        "cost": total["cost"],
+        "cache_hits": total["cache_hits"],
+        "output": str(output_file),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(module)s] [%(levelname)s] %(message)s")
+    args, forwarded = parse_args(argv)
+    metric = args.metric or ("f1" if args.task == "entity_resolution" else "acc")
+    space = json.load(open(args.space)) if args.space else DEFAULT_SPACE
+    configs = grid(space)
+    root = Path(args.output_dir)
+    root.mkdir(parents=True, exist_ok=True)
+
+    # The sweep's prompt cache goes first so a forwarded --prompt_cache overrides it
+    base_argv = ["--prompt_cache", str(root / "prompt_cache")] + forwarded + ["--task", args.task, "--data_dir", args.data_dir]
+    base_args = inference.parse_args(base_argv)
+    test_data = read_data(
+        task=args.task,
+        data_dir=args.data_dir,
+        cache_dir=base_args.data_cache_dir,
+        blocking_recall=base_args.blocking_recall,
+    )["test"]
+    # Create the shared stores up front rather than have the first runs race to set them up
+    if base_args.prompt_cache:
+        PromptCache(base_args.prompt_cache).close()
+    if args.task == "data_imputation":
+        ScoreStore(base_args.score_store).close()
+    max_rows = min(args.max_rows or len(test_data), len(test_data))
+    rungs = schedule(len(configs), args.min_rows, max_rows, args.eta)
+    logger.info(f"{len(configs)} configurations, rungs of {rungs} test rows, ranked by {metric}")
+
+    ctx = multiprocessing.get_context("spawn")
+    request_bucket = SharedTokenBucket(args.rpm, ctx=ctx) if args.rpm > 0 else None
+    token_bucket = SharedTokenBucket(args.tpm, ctx=ctx) if args.tpm > 0 else None
+    history, survivors = [], configs
+    for rung, rows in enumerate(rungs):
+        argvs = [
+            base_argv + _flags(config) + ["--test_rows", str(rows), "--output_dir", str(root / f"rung-{rung}" / f"config-{j:03d}")]
+            for j, config in enumerate(survivors)
+        ]
+        runs = {}
+        tasks = [[argvs[i] for i in chain] for chain in chains(survivors)]
+        with ctx.Pool(
+            min(args.processes, len(tasks)), initializer=_init_worker, initargs=(request_bucket, token_bucket), maxtasksperchild=1
+        ) as pool:
+            for chain in pool.imap_unordered(_run_chain, tasks):
+                for run_argv, output_file, seconds, error in chain:
+                    if error is not None:
+                        logger.error(f"Run {' '.join(run_argv)} failed:\n{error}")
+                    else:
+                        runs[tuple(run_argv)] = (Path(output_file), seconds)
+
+        results = [
+            read_result(config, rows, *runs[tuple(run_argv)], metric)
+            for config, run_argv in zip(survivors, argvs) if tuple(run_argv) in runs
+        ]
+        if not results:
+            raise SystemExit(f"Every run of rung {rung} failed")
+        history.append(results)
+        for r in sorted(results, key=lambda r: -r["metric"]):
+            logger.info(
+                f"rung {rung} ({rows} rows) {metric} {r['metric']:.3f} calls {r['calls']} tokens {r['tokens']} "
+                f"{r['seconds']:.1f}s {json.dumps(r['config'])}"
+            )
+        survivors = [r["config"] for r in promote(results, math.ceil(len(results) / args.eta))]
+
+    final = history[-1]
+    frontier = [r for r, rank in zip(final, pareto_ranks(final)) if rank == 0]
+    frontier.sort(key=lambda r: -r["metric"])
+    output = {
+        "task": args.task,
+        "data_dir": args.data_dir,
+        "metric": metric,
+        "space": space,
+        "rungs": rungs,
+        "frontier": frontier,
+        "history": history,
+    }
+    json.dump(output, open(root / "sweep.json", "w"), indent=2)
+    for r in frontier:
+        logger.info(f"Frontier: {metric} {r['metric']:.3f} calls {r['calls']} tokens {r['tokens']} {r['seconds']:.1f}s {json.dumps(r['config'])}")
+    logger.info(f"Sweep written to {root / 'sweep.json'}")
+    return output
+
+
+if __name__ == "__main__":
+    main()
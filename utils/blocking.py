@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Candidate-pair generation for entity resolution over raw `tableA`/`tableB`.
+
+    python -m utils.blocking --data_dir dataset/datasets/entity_matching/structured/Amazon-Google --recall 0.9 0.95 0.99
+
+calibrates the blocker on the labelled train/valid matches for every recall
+target and reports its pairs-completeness on the labelled test matches.
+"""
+import argparse
+import json
+import logging
+import math
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import constants
+from .data_utils import serialize_frame
+from .retrieval import NGramIndex
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_table(table: pd.DataFrame, sep_tok: str = ".", nan_tok: str = "nan") -> pd.Series:
+    """Serialize every entity of a table the way `read_blocked_pairs` serializes each side."""
+    return serialize_frame(table, {c: c for c in table.columns if c != "id"}, sep_tok, nan_tok)
+
+
+class Blocker():
+    """Top-k blocking on the q-gram TF-IDF cosine of serialized entities.
+
+    Table B goes into an `NGramIndex` (an inverted index of hashed character
+    q-grams), and every entity of table A is paired with its `k` most similar
+    entities of B. `calibrate` picks the smallest `k` that keeps a target share
+    of known matches, bounded by `max_k`.
+    """
+
+    def __init__(self, n: int = 3, max_k: int = 50):
+        self.n = n
+        self.max_k = max_k
+        self.k = max_k
+        self.index = None
+
+    def fit(self, texts_B: Sequence[str]) -> "Blocker":
+        self.index = NGramIndex(n=self.n).fit(list(texts_B))
+        return self
+
+    def match_ranks(self, texts_A: Sequence[str], positions_B: Sequence[int]) -> np.ndarray:
+        """0-based rank of each known match B among the candidates of its A (ties count against it)."""
+        ranks = np.empty(len(texts_A), dtype=np.int64)
+        cache = {}
+        for j, (text, b) in enumerate(zip(texts_A, positions_B)):
+            if text not in cache:
+                cache[text] = self.index.scores(text)
+            scores = cache[text]
+            # Every other candidate scoring as high may be picked first, so k covers the match however `query` breaks ties
+            ranks[j] = int((scores >= scores[b]).sum()) - 1
+        return ranks
+
+    def calibrate(self, texts_A: Sequence[str], positions_B: Sequence[int], recall: float) -> int:
+        """Set `k` to the smallest candidate count that reaches `recall` on the given matches."""
+        if len(texts_A) == 0:
+            logger.warning(f"No labelled matches to calibrate on, blocking with k={self.max_k}")
+            self.k = self.max_k
+            return self.k
+        ranks = np.sort(self.match_ranks(texts_A, positions_B))
+        needed = min(len(ranks), max(1, math.ceil(recall * len(ranks))))
+        self.k = int(ranks[needed - 1]) + 1
+        if self.k > self.max_k:
+            logger.warning(f"Recall {recall} needs k={self.k}, capped at {self.max_k}")
+            self.k = self.max_k
+        return self.k
+
+    def candidates(self, texts_A: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(positions in A, positions in B, scores) of the candidate pairs, best first within each A."""
+        positions_A, positions_B, scores = [], [], []
+        for a, text in enumerate(texts_A):
+            nearest, sims = self.index.query(text, self.k)
+            positions_A.append(np.full(len(nearest), a, dtype=np.int64))
+            positions_B.append(nearest)
+            scores.append(sims)
+        if not positions_A:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return np.concatenate(positions_A), np.concatenate(positions_B), np.concatenate(scores)
+
+
+def _matches(labels: pd.DataFrame, ids_A: pd.Index, ids_B: pd.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """Table positions of the labelled matches whose entities exist in both tables."""
+    matches = labels[labels["label"] == 1]
+    a = ids_A.get_indexer(matches["ltable_id"])
+    b = ids_B.get_indexer(matches["rtable_id"])
+    keep = (a >= 0) & (b >= 0)
+    return a[keep], b[keep]
+
+
+def block_tables(
+    tableA: pd.DataFrame,
+    tableB: pd.DataFrame,
+    labels: Optional[pd.DataFrame],
+    recall: float,
+    sep_tok: str = ".",
+    nan_tok: str = "nan",
+    n: int = 3,
+    max_k: int = 50,
+) -> Tuple[pd.DataFrame, Blocker]:
+    """Candidate pairs (ltable_id, rtable_id, score) of two tables, calibrated on labelled pairs.
+
+    `tableA`/`tableB` are the tables with their columns already dropped and renamed.
+    """
+    start = time.time()
+    texts_A = serialize_table(tableA, sep_tok, nan_tok).tolist()
+    texts_B = serialize_table(tableB, sep_tok, nan_tok).tolist()
+    ids_A, ids_B = pd.Index(tableA["id"]), pd.Index(tableB["id"])
+    blocker = Blocker(n=n, max_k=max_k).fit(texts_B)
+
+    if labels is not None:
+        a, b = _matches(labels, ids_A, ids_B)
+        blocker.calibrate([texts_A[j] for j in a], b, recall)
+
+    positions_A, positions_B, scores = blocker.candidates(texts_A)
+    pairs = pd.DataFrame({
+        "ltable_id": ids_A.to_numpy()[positions_A],
+        "rtable_id": ids_B.to_numpy()[positions_B],
+        "score": scores,
+    })
+    logger.info(
+        f"Blocking: {len(pairs)} candidate pairs of {len(tableA)}x{len(tableB)} (k={blocker.k}) "
+        f"in {time.time() - start:.1f}s"
+    )
+    return pairs, blocker
+
+
+def pairs_completeness(pairs: pd.DataFrame, labels: pd.DataFrame) -> float:
+    """Share of the labelled matches that are among the candidate pairs."""
+    matches = labels[labels["label"] == 1]
+    if len(matches) == 0:
+        return 1.0
+    found = pd.MultiIndex.from_frame(matches[["ltable_id", "rtable_id"]]).isin(
+        pd.MultiIndex.from_frame(pairs[["ltable_id", "rtable_id"]])
+    )
+    return float(found.mean())
+
+
+def read_tables(data_dir: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """`tableA`/`tableB` of a dataset folder with the dataset's columns dropped and renamed."""
+    dataset_name = data_dir.split('/')[-1]
+    cols_to_drop = constants.DATA2DROPCOLS[dataset_name]
+    col_renaming = constants.DATA2COLREMAP[dataset_name]
+    tables = []
+    for name in ["tableA.csv", "tableB.csv"]:
+        table = pd.read_csv(Path(data_dir) / name).drop(columns=cols_to_drop)
+        tables.append(table.rename(columns=col_renaming))
+    return tables[0], tables[1]
+
+
+def calibration_labels(data_dir: str) -> Optional[pd.DataFrame]:
+    """The labelled train and valid pairs of a dataset folder, if any."""
+    files = [Path(data_dir) / name for name in ["train.csv", "valid.csv"]]
+    labels = [pd.read_csv(f) for f in files if f.exists()]
+    return pd.concat(labels, ignore_index=True) if labels else None
+
+
+def benchmark(data_dir: str, recalls: Sequence[float], n: int = 3, max_k: int = 50) -> List[Dict]:
+    """Pairs-completeness on the test matches for each calibration recall target."""
+    tableA, tableB = read_tables(data_dir)
+    labels = calibration_labels(data_dir)
+    test_labels = pd.read_csv(Path(data_dir) / "test.csv")
+    results = []
+    for recall in recalls:
+        start = time.time()
+        pairs, blocker = block_tables(tableA, tableB, labels, recall, n=n, max_k=max_k)
+        seconds = time.time() - start
+        found = pairs_completeness(pairs, test_labels)
+        num_matches = int((test_labels["label"] == 1).sum())
+        results.append({
+            "recall_target": recall,
+            "k": blocker.k,
+            "candidates": len(pairs),
+            "pairs_completeness": found,
+            "reduction_ratio": 1.0 - len(pairs) / max(1, len(tableA) * len(tableB)),
+            "pairs_quality": found * num_matches / max(1, len(pairs)),
+            "labelled_candidates": len(test_labels),
+            "seconds": seconds,
+        })
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(module)s] [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Benchmark blocking against the labelled splits of a dataset.")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--recall", type=float, nargs="+", help="Recall targets to calibrate for.", default=[0.95])
+    parser.add_argument("--qgram", type=int, help="Character q-gram length.", default=3)
+    parser.add_argument("--max_k", type=int, help="Most candidates per entity of table A.", default=50)
+    args = parser.parse_args(argv)
+    print(json.dumps(benchmark(args.data_dir, args.recall, n=args.qgram, max_k=args.max_k), indent=2))
+
+
+if __name__ == "__main__":
+    main()
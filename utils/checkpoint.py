@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(obj) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Checkpoint():
+    """Append-only JSON-lines record of finished test rows.
+
+    The first line is a header with the run configuration and the RNG state the
+    run started from; every following line is one finished row. Rows are buffered
+    and written (and fsync'ed) every `every` rows, so a crash loses at most that
+    many. A torn last line is ignored on load.
+    """
+
+    def __init__(self, path: str, config: Dict, every: int = 50, resume: bool = False):
+        self.path = Path(path)
+        self.every = max(1, every)
+        self.config = _fingerprint(config)
+        self.header = None
+        self.finished = {}
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and self.path.exists():
+            self._load()
+        else:
+            self.path.write_text("")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("type") == "header":
+                    self.header = record
+                elif record.get("type") == "row":
+                    self.finished[str(record["id"])] = record
+        if self.header is not None and self.header["config"] != self.config:
+            raise ValueError(f"Checkpoint {self.path} was written with different arguments; cannot resume.")
+        logger.info(f"Resuming from {self.path}: {len(self.finished)} rows already finished")
+
+    def bind_rng(self, rng: np.random.RandomState):
+        """Restore the RNG state of the interrupted run, or record it for a new one.
+
+        All sampling happens in the planning pass before any row runs, so the
+        start-of-run state is enough to redraw identical candidates for the rows left.
+        """
+        if self.header is not None:
+            kind, keys, pos, has_gauss, cached = self.header["rng"]
+            rng.set_state((kind, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+            return
+        kind, keys, pos, has_gauss, cached = rng.get_state()
+        self.header = {"type": "header", "config": self.config, "rng": [kind, keys.tolist(), pos, has_gauss, cached]}
+        self._write([json.dumps(self.header)])
+
+    def is_finished(self, row_id) -> bool:
+        return str(row_id) in self.finished
+
+    def add(self, record: Dict):
+        line = json.dumps(dict(record, type="row"), default=_to_builtin)
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.every:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._write(self._buffer)
+            self._buffer = []
+
+    def _write(self, lines: List[str]):
+        with open(self.path, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _to_builtin(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import asyncio
+import collections
+import copy
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+import urllib.parse
+from typing import Optional
+
+
+class LLMRequestError(Exception):
+    """A completion request that failed at the transport or HTTP level."""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """Connection errors, rate limits (429) and server errors (5xx) are worth retrying."""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class Completion():
+    """Generated text with its usage; the dispatcher fills in latency and retries."""
+
+    def __init__(
+        self,
+        text: str,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        cache_hit: bool = False,
+        logprob: Optional[float] = None,
+    ):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cache_hit = cache_hit
+        # Summed log-probability of the generated tokens, when requested and supported
+        self.logprob = logprob
+        self.latency = 0.0
+        self.retries = 0
+
+
+class Prompt(str):
+    """A prompt that remembers its shared prefix, e.g. few-shot examples common to many requests.
+
+    It is an ordinary string everywhere else. Keeping the prefix byte-identical and
+    first lets servers with automatic prefix caching reuse it, and `LocalClient`
+    keeps the model state of recent prefixes.
+    """
+
+    prefix_len = 0
+
+    @classmethod
+    def join(cls, prefix: str, suffix: str) -> "Prompt":
+        prompt = cls(prefix + suffix)
+        prompt.prefix_len = len(prefix)
+        return prompt
+
+    @property
+    def prefix(self) -> str:
+        return str(self[:self.prefix_len])
+
+    @property
+    def suffix(self) -> str:
+        return str(self[self.prefix_len:])
+
+
+def _retry_after(headers) -> Optional[float]:
+    value = headers.get("Retry-After") if headers is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMClient():
+    """Interface shared by all completion backends.
+
+    `complete` blocks and is safe to call from several threads at once; the
+    `Dispatcher` wraps it with concurrency limits, rate limits and retries.
+    `model_id` names the backend and model for response caching.
+    """
+
+    model_id = "unknown"
+
+    def complete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        raise NotImplementedError("")
+
+    async def acomplete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        return await asyncio.get_running_loop().run_in_executor(None, self.complete, prompt, stop_token, logprobs)
+
+    def close(self):
+        pass
+
+
+def _truncate(text: str, stop_token: Optional[str]) -> str:
+    if stop_token and stop_token in text:
+        return text[:text.index(stop_token)]
+    return text
+
+
+class ManifestClient(LLMClient):
+    """Blocking completions through Manifest's OpenAI client and sqlite cache."""
+
+    def __init__(
+        self,
+        temperature: float,
+        max_tokens: int,
+        cache_name: str = "sqlite",
+        cache_connection: str = "unifdt.sqlite",
+    ):
+        from manifest import Manifest
+
+        self.model_id = "manifest:openai"
+        self.manifest = Manifest(
+            client_name='openai',
+            cache_name=cache_name,
+            cache_connection=cache_connection,
+            stop_token='\n',
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=1.0,
+            n=1,
+        )
+
+    def complete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        try:
+            response = self.manifest.run(prompt=prompt, stop_token=stop_token, return_response=True)
+        except Exception as e:
+            response = getattr(e, "response", None)
+            status = getattr(response, "status_code", None)
+            # Anything that is neither an HTTP error nor an I/O error is a bug, not a transient failure.
+            if status is None and not isinstance(e, OSError):
+                raise
+            headers = getattr(response, "headers", None)
+            raise LLMRequestError(str(e), status=status, retry_after=_retry_after(headers)) from e
+        usages = response.get_usage_obj().usages
+        usage = usages[0] if usages else None
+        return Completion(
+            response.get_response(),
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            cache_hit=response.is_cached(),
+        )
+
+
+class _ConnectionPool():
+    """Keep-alive HTTP(S) connections to one endpoint, shared by all worker threads.
+
+    Idle connections are reused most-recent first; at most `size` are kept open.
+    """
+
+    def __init__(self, url: str, size: int, timeout: float):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == "https"
+        self.host, self.port = parts.hostname, parts.port
+        self.path = parts.path or "/"
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        connection_cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        connection = connection_cls(self.host, self.port, timeout=self.timeout)
+        connection.connect()
+        # http.client writes headers and body separately; don't let Nagle hold back the body
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def _release(self, connection: http.client.HTTPConnection):
+        if self._idle.qsize() < self.size:
+            self._idle.put(connection)
+        else:
+            connection.close()
+
+    def post(self, body: bytes, headers: dict):
+        """Return (status, headers, body) of a POST to the pool's endpoint."""
+        for attempt in range(2):
+            try:
+                connection, reused = self._idle.get_nowait(), True
+            except queue.Empty:
+                connection, reused = self._connect(), False
+            try:
+                connection.request("POST", self.path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+                connection.close()
+                # The server may have dropped an idle keep-alive connection; retry once on a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, response.headers, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class OpenAIClient(LLMClient):
+    """Blocking completions against any OpenAI-compatible `/completions` endpoint over pooled keep-alive connections."""
+
+    def __init__(
+        self,
+        api_base: str,
+        api_key: str,
+        engine: str,
+        temperature: float,
+        max_tokens: int,
+        top_p: float = 1.0,
+        timeout: float = 60.0,
+        max_connections: int = 8,
+    ):
+        self.url = api_base.rstrip('/') + "/completions"
+        self.model_id = f"openai:{self.url}:{engine}"
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        self.params = {
+            "model": engine,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+            "n": 1,
+        }
+        self.pool = _ConnectionPool(self.url, size=max_connections, timeout=timeout)
+
+    def complete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        payload = dict(self.params, prompt=prompt)
+        if stop_token:
+            payload["stop"] = [stop_token]
+        if logprobs:
+            payload["logprobs"] = 1
+        try:
+            status, headers, data = self.pool.post(json.dumps(payload).encode("utf-8"), self.headers)
+        except (http.client.HTTPException, OSError) as e:
+            raise LLMRequestError(f"Request to {self.url} failed: {e}") from e
+        if status >= 400:
+            raise LLMRequestError(f"HTTP {status} from {self.url}", status=status, retry_after=_retry_after(headers))
+        body = json.loads(data)
+        usage = body.get("usage") or {}
+        choice = body["choices"][0]
+        token_logprobs = (choice.get("logprobs") or {}).get("token_logprobs")
+        return Completion(
+            choice["text"],
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            logprob=sum(lp for lp in token_logprobs if lp is not None) if token_logprobs else None,
+        )
+
+    def close(self):
+        self.pool.close()
+
+
+class LocalClient(LLMClient):
+    """CPU inference with a local model: a llama.cpp `.gguf` file or a Hugging Face causal LM.
+
+    One generation runs at a time; concurrent callers queue on a lock. The KV cache
+    of shared prompt prefixes is kept and reused: by llama.cpp's prompt cache, and
+    for `Prompt`s with a prefix, by the `num_prefixes` most recent prefixes for Hugging Face models.
+    """
+
+    def __init__(self, model_path: str, temperature: float, max_tokens: int, num_prefixes: int = 4):
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.model_id = f"local:{os.path.abspath(model_path) if os.path.exists(model_path) else model_path}"
+        self.num_prefixes = num_prefixes
+        self._prefix_cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if model_path.endswith(".gguf"):
+            from llama_cpp import Llama, LlamaRAMCache
+
+            self.llama = Llama(model_path=model_path, n_ctx=4096, verbose=False)
+            self.llama.set_cache(LlamaRAMCache())
+        else:
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            self.llama = None
+            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+            self.model = AutoModelForCausalLM.from_pretrained(model_path).eval()
+
+    def complete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        with self._lock:
+            if self.llama is not None:
+                out = self.llama(
+                    prompt,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    stop=[stop_token] if stop_token else None,
+                    logprobs=1 if logprobs else None,
+                )
+                usage = out["usage"]
+                token_logprobs = (out["choices"][0].get("logprobs") or {}).get("token_logprobs")
+                return Completion(
+                    out["choices"][0]["text"],
+                    prompt_tokens=usage["prompt_tokens"],
+                    completion_tokens=usage["completion_tokens"],
+                    logprob=sum(token_logprobs) if token_logprobs else None,
+                )
+
+            kwargs = {"max_new_tokens": self.max_tokens, "pad_token_id": self.tokenizer.eos_token_id}
+            if self.temperature > 0:
+                kwargs.update(do_sample=True, temperature=self.temperature)
+            else:
+                kwargs.update(do_sample=False)
+            if getattr(prompt, "prefix_len", 0) > 0:
+                input_ids, past_key_values = self._with_prefix(prompt)
+                kwargs["past_key_values"] = past_key_values
+            else:
+                input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"]
+            num_prompt_tokens = input_ids.shape[1]
+            output = self.model.generate(input_ids=input_ids, attention_mask=input_ids.new_ones(input_ids.shape), **kwargs)
+            output = output[0, num_prompt_tokens:]
+        text = self.tokenizer.decode(output, skip_special_tokens=True)
+        return Completion(_truncate(text, stop_token), prompt_tokens=num_prompt_tokens, completion_tokens=len(output))
+
+    def _with_prefix(self, prompt: Prompt):
+        """Token ids of `prompt` and a private copy of its prefix's KV cache, computed once per prefix."""
+        import torch
+
+        prefix = prompt.prefix
+        if prefix in self._prefix_cache:
+            self._prefix_cache.move_to_end(prefix)
+        else:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"]
+            with torch.no_grad():
+                past_key_values = self.model(prefix_ids, use_cache=True).past_key_values
+            self._prefix_cache[prefix] = (prefix_ids, past_key_values)
+            if len(self._prefix_cache) > self.num_prefixes:
+                self._prefix_cache.popitem(last=False)
+        prefix_ids, past_key_values = self._prefix_cache[prefix]
+        suffix_ids = self.tokenizer(prompt.suffix, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        # Generation extends the cache in place, so every call gets its own copy
+        return torch.cat([prefix_ids, suffix_ids], dim=1), copy.deepcopy(past_key_values)
+
+
+class StubClient(LLMClient):
+    """Deterministic offline answers from `utils.mock_server.mock_response`, without any HTTP."""
+
+    def __init__(self, responder=None):
+        from .mock_server import mock_response
+
+        self.responder = responder or mock_response
+        self.model_id = "stub"
+
+    def complete(self, prompt: str, stop_token: Optional[str] = None, logprobs: bool = False) -> Completion:
+        text = _truncate(self.responder(prompt), stop_token)
+        return Completion(text, prompt_tokens=len(prompt) // 4, completion_tokens=len(text) // 4)
+
+
+def build_client(args) -> LLMClient:
+    """Create the backend chosen by `--client`; without it, OpenAI-compatible HTTP if `--api_base` is set, else Manifest."""
+    name = args.client or ("openai" if args.api_base else "manifest")
+    if name == "manifest":
+        # With our own prompt cache in front, a second Manifest cache would only duplicate it
+        return ManifestClient(
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            cache_name="noop" if args.prompt_cache else "sqlite",
+        )
+    if name == "openai":
+        return OpenAIClient(
+            api_base=args.api_base or "https://api.openai.com/v1",
+            api_key=os.environ.get("OPENAI_API_KEY", ""),
+            engine=args.engine,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            max_connections=args.max_in_flight,
+        )
+    if name == "local":
+        if not args.local_model:
+            raise ValueError("--client local needs --local_model.")
+        return LocalClient(args.local_model, temperature=args.temperature, max_tokens=args.max_tokens)
+    if name == "stub":
+        return StubClient()
+    raise ValueError(f"Unknown client {name}.")
@@ -82,3 +82,16 @@ DATA2COLREMAP = {
     f"benchmark-bing-query-logs": {},
 }
 
+
+# USD per 1K (prompt, completion) tokens
+MODEL_PRICES = {
+    "text-davinci-003": (0.02, 0.02),
+    "text-davinci-002": (0.02, 0.02),
+    "gpt-3.5-turbo-instruct": (0.0015, 0.002),
+    "davinci-002": (0.002, 0.002),
+    "babbage-002": (0.0004, 0.0004),
+}
+DEFAULT_MODEL_PRICE = (0.02, 0.02)
+
+# LLM backends of `--client`, built by `utils.clients.build_client`
+CLIENTS = ["manifest", "openai", "local", "stub"]
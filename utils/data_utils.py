@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
-import logging, os
+import hashlib, json, logging, os, shutil
 from functools import partial
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Sequence
+import numpy as np
 import pandas as pd
 
 from . import constants
 
 logger = logging.getLogger(__name__)
 
+# Bump when the preparation steps change so stale prepared datasets are rebuilt
+PREPARED_VERSION = 3
+
 
 def sample_train_data(train: pd.DataFrame, n_rows: int):
     res = train.sample(n_rows)
@@ -25,14 +29,49 @@ def serialize_row(
     res = []
     for c_og, c_map in column_map.items():
         if str(row[c_og]) == "nan":
-            row[c_og] = nan_tok
+            value = nan_tok
         else:
-            row[c_og] = f"{str(row[c_og]).strip()}"
-        res.append(f"{c_map}: {row[c_og]}".lstrip())
+            value = f"{str(row[c_og]).strip()}"
+        res.append(f"{c_map}: {value}".lstrip())
     if len(sep_tok) > 0 and sep_tok != ".":
         sep_tok = f" {sep_tok}"
     return f"{sep_tok} ".join(res)
 
+_to_str = np.frompyfunc(str, 1, 1)
+_strip = np.frompyfunc(str.strip, 1, 1)
+
+def serialize_frame(
+    frame: pd.DataFrame,
+    column_map: Dict[str, str],
+    sep_tok: str = ".",
+    nan_tok: str = "nan",
+) -> pd.Series:
+    """Turn every row of a frame into a string, column by column.
+
+    Gives the same strings as `frame.apply(lambda row: serialize_row(row, ...), axis=1)`
+    without building a Series per row, and leaves `frame` untouched.
+    """
+    if len(sep_tok) > 0 and sep_tok != ".":
+        sep_tok = f" {sep_tok}"
+    # Rows of apply carry the frame's common dtype (e.g. ints upcast to float in an
+    # all-numeric frame); read the values the same way to match byte for byte. A
+    # nullable common dtype keeps its scalars, so missing values print as "<NA>"
+    row_dtype = frame.iloc[0].dtype if len(frame) else None
+    if isinstance(row_dtype, pd.api.extensions.ExtensionDtype):
+        values = frame.astype(row_dtype).to_numpy(dtype=object)
+    else:
+        values = frame.to_numpy()
+    res = None
+    for c_og, c_map in column_map.items():
+        text = _to_str(values[:, frame.columns.get_loc(c_og)])
+        cell = np.where(text == "nan", nan_tok, _strip(text))
+        # The key always holds ":", so lstrip of the whole piece only touches the key
+        piece = f"{c_map}: ".lstrip() + cell
+        res = piece if res is None else res + f"{sep_tok} " + piece
+    if res is None:
+        res = np.full(len(frame), "", dtype=object)
+    return pd.Series(res, index=frame.index, dtype=object)
+
 def serialize_match_pair(
     row: pd.core.series.Series,
     column_mapA: Dict[str, str],
@@ -92,7 +131,7 @@ def serialize_error_detection(
 
 
 def read_blocked_pairs(
-    split_path: str,
+    split_path,
     tableA: pd.DataFrame,
     tableB: pd.DataFrame,
     cols_to_drop: List[str],
@@ -100,7 +139,11 @@ def read_blocked_pairs(
     sep_tok: str,
     nan_tok: str,
 ) -> pd.DataFrame:
-    """Read in pre-blocked pairs with T/F match labels."""
+    """Read in pre-blocked pairs with T/F match labels.
+
+    `split_path` is a label file, or an already-read chunk of one. Pairs without
+    a label column (blocked from raw tables) get an empty `label_str`.
+    """
     for c in cols_to_drop:
         tableA = tableA.drop(c, axis=1, inplace=False)
         tableB = tableB.drop(c, axis=1, inplace=False)
@@ -111,7 +154,7 @@ def read_blocked_pairs(
     column_mapA = {f"{c}_A": c for c in tableA.columns if c != "id"}
     column_mapB = {f"{c}_B": c for c in tableB.columns if c != "id"}
 
-    labels = pd.read_csv(split_path)
+    labels = split_path if isinstance(split_path, pd.DataFrame) else pd.read_csv(split_path)
 
     mergedA = pd.merge(labels, tableA, right_on="id", left_on="ltable_id")
     merged = pd.merge(
@@ -122,40 +165,25 @@ def read_blocked_pairs(
         suffixes=("_A", "_B"),
     )
 
-    merged["serialized_A"] = merged.apply(
-        lambda row: serialize_row(
-            row,
-            column_mapA,
-            sep_tok,
-            nan_tok,
-        ),
-        axis=1,
-    )
-    merged["serialized_B"] = merged.apply(
-        lambda row: serialize_row(
-            row,
-            column_mapB,
-            sep_tok,
-            nan_tok,
-        ),
-        axis=1,
-    )
-    merged["label_str"] = merged.apply(
-        lambda row: "Yes\n" if row["label"] == 1 else "No\n", axis=1
-    )
+    merged["serialized_A"] = serialize_frame(merged, column_mapA, sep_tok, nan_tok)
+    merged["serialized_B"] = serialize_frame(merged, column_mapB, sep_tok, nan_tok)
+    if "label" in merged.columns:
+        merged["label_str"] = np.where(merged["label"] == 1, "Yes\n", "No\n")
+    else:
+        merged["label_str"] = ""
     return merged
 
 
 def read_imputation_single(
-    split_path: str,
+    split_path,
     impute_col: str,
     cols_to_drop: List[str],
     col_renaming: Dict[str, str],
     sep_tok: str,
     nan_tok: str,
 ) -> pd.DataFrame:
-    """Read in table and create label impute col."""
-    table = pd.read_csv(split_path)
+    """Read in table (a file, or an already-read chunk of one) and create label impute col."""
+    table = split_path if isinstance(split_path, pd.DataFrame) else pd.read_csv(split_path)
     for c in cols_to_drop:
         table = table.drop(c, axis=1, inplace=False)
     if len(col_renaming) > 0:
@@ -194,30 +222,67 @@ def read_transformation(
         column_map = {c: c for c in file.columns}
         train, test = file[:3], file[3:]
 
-        context = train.apply(
-            lambda row: serialize_row(
-                row,
-                column_map,
-                sep_tok,
-            ),
-            axis=1,
-        )
+        context = serialize_frame(train, column_map, sep_tok)
         context = "\n\n".join(list(context))
         
-        for _,row in test.iterrows():
-            table.append([instruction,context,str(row[0]),str(row[1])])
+        values = _to_str(test.to_numpy())
+        for row in values:
+            table.append([instruction,context,row[0],row[1]])
 
     table = pd.DataFrame(table, columns=['instruction','context','input','label_str'])
     return table
 
 
+def block_test_pairs(
+    data_dir: str,
+    tableA: pd.DataFrame,
+    tableB: pd.DataFrame,
+    cols_to_drop: List[str],
+    col_renaming: Dict[str, str],
+    recall: float,
+    sep_tok: str,
+    nan_tok: str,
+) -> pd.DataFrame:
+    """Test pairs blocked from the raw tables, calibrated on the labelled train/valid matches.
+
+    Candidates labelled in train/valid are dropped, so no train pair is scored as a test pair.
+    Labels of `test.csv`, when there is one, are carried over; candidates outside every
+    labelled split count as non-matches.
+    """
+    from .blocking import block_tables, calibration_labels
+
+    keys = ["ltable_id", "rtable_id"]
+    tableA = tableA.drop(columns=cols_to_drop).rename(columns=col_renaming)
+    tableB = tableB.drop(columns=cols_to_drop).rename(columns=col_renaming)
+    labels = calibration_labels(data_dir)
+    pairs, _ = block_tables(tableA, tableB, labels, recall, sep_tok, nan_tok)
+    if labels is not None:
+        labelled = pairs.merge(labels[keys].drop_duplicates(), how="left", on=keys, indicator=True)["_merge"] == "both"
+        if labelled.any():
+            logger.info(f"Dropped {labelled.sum()} of {len(pairs)} blocked pairs labelled in train/valid")
+        pairs = pairs[~labelled.to_numpy()].reset_index(drop=True)
+    test_file = Path(data_dir) / "test.csv"
+    if test_file.exists():
+        test_labels = pd.read_csv(test_file)[keys + ["label"]].drop_duplicates(keys)
+        pairs = pairs.merge(test_labels, how="left", on=keys)
+        logger.info(f"{pairs['label'].isna().sum()} of {len(pairs)} blocked pairs are not in {test_file}, labelled 0")
+        pairs["label"] = pairs["label"].fillna(0).astype(int)
+    return pairs
+
+
 def read_raw_data(
     task: str,
     data_dir: str,
     sep_tok: str = ".",
     nan_tok: str = "nan",
+    splits: Sequence[str] = ("train", "test", "validation"),
+    blocking_recall: float = 0.0,
 ):
-    """Read in data where each directory is unique for a task."""
+    """Read in data where each directory is unique for a task.
+
+    For entity resolution with `blocking_recall` > 0, the test pairs are blocked
+    from `tableA`/`tableB` instead of read from `test.csv`.
+    """
     dataset_name = data_dir.split('/')[-1]
     data_files_sep = {"test": {}, "train": {}, "validation": {}}
     logger.info(f"Processing {dataset_name}")
@@ -234,6 +299,12 @@ def read_raw_data(
 
         tableA = pd.read_csv(tableA_file)
         tableB = pd.read_csv(tableB_file)
+        if blocking_recall > 0 and "test" in splits:
+            test_file = block_test_pairs(
+                data_dir, tableA, tableB, cols_to_drop, col_renaming, blocking_recall, sep_tok, nan_tok
+            )
+        elif not test_file.exists() and "test" in splits:
+            raise ValueError(f"No {test_file}; set a blocking recall to generate test pairs from the tables.")
 
         label_col = "label"
         read_data_func = partial(
@@ -289,27 +360,183 @@ def read_raw_data(
     else:
         raise ValueError(f"Task {task} not recognized.")
 
-    data_files_sep["train"] = read_data_func(train_file)
-    data_files_sep["test"] = read_data_func(test_file)
+    if "train" in splits:
+        data_files_sep["train"] = read_data_func(train_file)
+    if "test" in splits:
+        data_files_sep["test"] = read_data_func(test_file)
     # Read validation
-    if valid_file.exists():
+    if "validation" in splits and valid_file.exists():
         data_files_sep["validation"] = read_data_func(valid_file)
     return data_files_sep, label_col
 
 
+def iter_test_data(
+    task: str,
+    data_dir: str,
+    chunksize: int,
+    sep_tok: str = ".",
+    nan_tok: str = "nan",
+):
+    """Yield the test split in chunks of `chunksize` rows, prepared as in `read_data`.
+
+    Reads row groups of `test.parquet` when present, else `test.csv`. Row ids
+    continue across chunks, so they match the ids of a non-streaming run.
+    """
+    dataset_name = data_dir.split('/')[-1]
+    cols_to_drop = constants.DATA2DROPCOLS[dataset_name]
+    col_renaming = constants.DATA2COLREMAP[dataset_name]
+    data_dir_p = Path(data_dir)
+
+    if task == "entity_resolution":
+        tableA = pd.read_csv(data_dir_p / "tableA.csv").drop(columns=cols_to_drop)
+        tableB = pd.read_csv(data_dir_p / "tableB.csv").drop(columns=cols_to_drop)
+        read_chunk = partial(
+            read_blocked_pairs,
+            tableA=tableA.rename(columns=col_renaming),
+            tableB=tableB.rename(columns=col_renaming),
+            cols_to_drop=[],
+            col_renaming={},
+            sep_tok=sep_tok,
+            nan_tok=nan_tok,
+        )
+    elif task == "data_imputation":
+        read_chunk = partial(
+            read_imputation_single,
+            impute_col=constants.IMPUTE_COLS[dataset_name],
+            cols_to_drop=cols_to_drop,
+            col_renaming=col_renaming,
+            sep_tok=sep_tok,
+            nan_tok=nan_tok,
+        )
+    else:
+        raise ValueError(f"Streaming is not supported for task {task}.")
+
+    parquet_file = data_dir_p / "test.parquet"
+    if parquet_file.exists():
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(parquet_file).iter_batches(batch_size=chunksize)
+        chunks = (batch.to_pandas() for batch in batches)
+    else:
+        chunks = pd.read_csv(data_dir_p / "test.csv", chunksize=chunksize)
+
+    offset = 0
+    for chunk in chunks:
+        table = read_chunk(chunk.reset_index(drop=True))
+        table.index = pd.RangeIndex(offset, offset + len(table))
+        offset += len(table)
+        yield table
+
+
+def source_fingerprint(data_dir: str) -> str:
+    """Digest of the preparation version and the name, size and mtime of every file under `data_dir`."""
+    sources = []
+    for path in sorted(Path(data_dir).rglob("*")):
+        if path.is_file():
+            stat = path.stat()
+            sources.append([str(path.relative_to(data_dir)), stat.st_size, stat.st_mtime_ns])
+    key = {"version": PREPARED_VERSION, "sources": sources}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def prepared_data_path(
+    cache_dir: str,
+    task: str,
+    data_dir: str,
+    sep_tok: str,
+    nan_tok: str,
+    blocking_recall: float = 0.0,
+) -> Path:
+    """Folder of the prepared dataset, keyed by everything the preparation depends on."""
+    dataset_name = data_dir.split('/')[-1]
+    key = {
+        "source": source_fingerprint(data_dir),
+        "task": task,
+        "sep_tok": sep_tok,
+        "nan_tok": nan_tok,
+        "drop_cols": constants.DATA2DROPCOLS.get(dataset_name),
+        "col_remap": constants.DATA2COLREMAP.get(dataset_name),
+        "impute_col": constants.IMPUTE_COLS.get(dataset_name),
+    }
+    if blocking_recall > 0:
+        key["blocking_recall"] = blocking_recall
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return Path(cache_dir) / f"{dataset_name}-{task}-{digest}"
+
+
+def load_prepared_data(path: Path, splits: Sequence[str] = ("train", "test", "validation")):
+    """Memory-map the Feather splits written by `save_prepared_data`."""
+    from pyarrow import feather
+
+    data_files_sep = {"test": {}, "train": {}, "validation": {}}
+    for split in splits:
+        split_file = path / f"{split}.feather"
+        if split_file.exists():
+            table = feather.read_table(split_file, memory_map=True).to_pandas()
+            # Arrow stores missing strings as null; the serializers expect nan
+            for c in table.columns[table.dtypes == object]:
+                table[c] = table[c].where(table[c].notna(), np.nan)
+            data_files_sep[split] = table
+    return data_files_sep
+
+
+def save_prepared_data(path: Path, data_files_sep: Dict, data_dir: str):
+    """Write the prepared splits as Feather, removing the versions of the dataset prepared from older source files.
+
+    Versions with other preparation settings stay valid and are kept.
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    source = {"data_dir": str(Path(data_dir).resolve()), "fingerprint": source_fingerprint(data_dir)}
+    try:
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        for split, table in data_files_sep.items():
+            if isinstance(table, pd.DataFrame):
+                table.to_feather(tmp_path / f"{split}.feather")
+        (tmp_path / "source.json").write_text(json.dumps(source))
+        for other in path.parent.glob(path.name.rsplit("-", 1)[0] + "-*"):
+            if not other.is_dir() or ".tmp" in other.name or other == path:
+                continue
+            try:
+                other_source = json.loads((other / "source.json").read_text())
+            except (OSError, ValueError):
+                continue
+            if other_source["data_dir"] == source["data_dir"] and other_source["fingerprint"] != source["fingerprint"]:
+                shutil.rmtree(other, ignore_errors=True)
+        os.replace(tmp_path, path)
+        logger.info(f"Prepared dataset cached at {path}")
+    except Exception as e:
+        logger.warning(f"Could not cache prepared dataset at {path}: {e}")
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 def read_data(
     task: str,
     data_dir: str,
     class_balanced: bool = False,
     sep_tok: str = ".",
     nan_tok: str = "nan",
+    cache_dir: str = None,
+    splits: Sequence[str] = ("train", "test", "validation"),
+    blocking_recall: float = 0.0,
 ):
-    """Read in data where each directory is unique for a task."""
+    """Read in data where each directory is unique for a task.
+
+    Only `splits` are read; the prepared-data cache is written for complete reads only.
+    """
+    if cache_dir:
+        cache_path = prepared_data_path(cache_dir, task, data_dir, sep_tok, nan_tok, blocking_recall)
+        if (cache_path / "train.feather").exists():
+            logger.info(f"Loading prepared dataset from {cache_path}")
+            return load_prepared_data(cache_path, splits)
+
     data_files_sep, label_col = read_raw_data(
         task=task,
         data_dir=data_dir,
         sep_tok=sep_tok,
         nan_tok=nan_tok,
+        splits=splits,
+        blocking_recall=blocking_recall,
     )
 
     # Shuffle train data
@@ -317,4 +544,6 @@ def read_data(
         data_files_sep["train"].sample(frac=1, random_state=42).reset_index(drop=True)
     )
 
+    if cache_dir and set(splits) >= {"train", "test", "validation"}:
+        save_prepared_data(cache_path, data_files_sep, data_dir)
     return data_files_sep
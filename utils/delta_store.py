@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import hashlib
+import json
+from typing import Dict, List, Tuple
+
+from .sqlite_store import SqliteStore
+from .templates import expand
+
+
+class DeltaStore(SqliteStore):
+    """Finished test rows keyed by a fingerprint of everything their prediction depends on.
+
+    A fingerprint hashes the row's serialized input, its retrieval pool and the run
+    configuration, so a re-run over a partly changed table reuses the rows whose
+    inputs are unchanged and recomputes the rest.
+    """
+
+    table = "rows"
+    columns = ("pred TEXT NOT NULL", "prompt_as TEXT NOT NULL", "score TEXT")
+
+    @staticmethod
+    def key(config: Dict, target: str, pool: List[str]) -> str:
+        payload = json.dumps({"config": config, "target": target, "pool": pool}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def encode(self, row: Dict) -> Tuple:
+        return row["pred"], expand(row["prompt_as"]), json.dumps(row.get("score"))
+
+    def decode(self, columns: Tuple) -> Dict:
+        pred, prompt_as, score = columns
+        return {"pred": pred, "prompt_as": prompt_as, "score": json.loads(score)}
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import asyncio
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+
+from .clients import Completion, LLMRequestError
+
+
+class TokenBucket():
+    """Token bucket refilled continuously at `per_minute` tokens per minute.
+
+    `reserve` lets the balance go negative and returns how long the caller has to
+    wait for its tokens, so callers on one event loop queue up fairly without a lock.
+    The full amount is charged even above the burst capacity, so large prompts pay
+    for all of their tokens.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 1.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket whose balance lives in shared memory, so worker processes draw from one budget.
+
+    Create it in the parent and hand it to workers at start-up, e.g. as a pool initializer argument.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 1.0, ctx=multiprocessing):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self._state = ctx.Array("d", [self.capacity, time.monotonic()])
+
+    def reserve(self, amount: float) -> float:
+        with self._state.get_lock():
+            now = time.monotonic()
+            tokens = min(self.capacity, self._state[0] + (now - self._state[1]) * self.rate)
+            tokens -= amount
+            self._state[0], self._state[1] = tokens, now
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+# Buckets every Dispatcher of this process uses instead of its own, see `share_limits`
+_shared_limits = {}
+
+
+def share_limits(request_bucket: Optional[TokenBucket] = None, token_bucket: Optional[TokenBucket] = None):
+    """Make every Dispatcher created in this process draw from the given request and token buckets."""
+    _shared_limits["request"] = request_bucket
+    _shared_limits["token"] = token_bucket
+
+
+def has_shared_limits() -> bool:
+    return any(bucket is not None for bucket in _shared_limits.values())
+
+
+class Dispatcher():
+    """Run blocking completion calls concurrently from synchronous code.
+
+    Calls are scheduled on an event loop owned by a background thread: at most
+    `max_in_flight` requests are outstanding, requests/min and tokens/min are
+    enforced by token buckets (0 disables a limit), and retryable failures
+    (429, 5xx, connection errors) are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_in_flight: int = 8,
+        rpm: float = 0,
+        tpm: float = 0,
+        max_tokens: int = 0,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.request_bucket = _shared_limits.get("request") or (TokenBucket(rpm) if rpm > 0 else None)
+        self.token_bucket = _shared_limits.get("token") or (TokenBucket(tpm) if tpm > 0 else None)
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self._jitter = random.Random()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="unidm-llm")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="unidm-dispatch", daemon=True)
+        self._thread.start()
+        self._semaphore = self._submit(self._make_semaphore()).result()
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.max_in_flight)
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _throttle(self, prompt: str):
+        delay = 0.0
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            # Providers count the completion budget against the limit as well.
+            delay = max(delay, self.token_bucket.reserve(len(prompt) // 4 + self.max_tokens))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+        delay = self._jitter.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def acomplete(self, prompt: str, **kwargs) -> Completion:
+        start = time.monotonic()
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._throttle(prompt)
+                try:
+                    completion = await self._loop.run_in_executor(
+                        self._executor, partial(self.client.complete, prompt, **kwargs)
+                    )
+                    # Latency as the caller sees it: queueing, throttling and retries included
+                    completion.latency = time.monotonic() - start
+                    completion.retries = attempt
+                    return completion
+                except LLMRequestError as e:
+                    if not e.retryable or attempt == self.max_retries:
+                        raise
+                    delay = self._backoff_delay(attempt, e.retry_after)
+                    self.logger.warning(f"LLM request failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+
+    async def _gather(self, prompts: List[str], **kwargs) -> List[Completion]:
+        return list(await asyncio.gather(*[self.acomplete(p, **kwargs) for p in prompts]))
+
+    def run(self, prompt: str, **kwargs) -> Completion:
+        """Complete one prompt, blocking the calling thread."""
+        return self._submit(self.acomplete(prompt, **kwargs)).result()
+
+    def run_batch(self, prompts: List[str], **kwargs) -> List[Completion]:
+        """Complete independent prompts concurrently, results in input order."""
+        if len(prompts) == 0:
+            return []
+        return self._submit(self._gather(list(prompts), **kwargs)).result()
+
+    def close(self):
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._executor.shutdown(wait=False)
+        self.client.close()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Local OpenAI-compatible completion server for offline runs.
+
+    python -m utils.mock_server --port 8000 --latency 0.2 --error_rate 0.05
+    python inference.py --api_base http://127.0.0.1:8000/v1 --api_key mock ...
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Sequence
+
+
+def _digest(prompt: str) -> int:
+    return int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16)
+
+
+def mock_response(prompt: str) -> str:
+    """Deterministic answer shaped like what each UniDM prompt expects."""
+    h = _digest(prompt)
+    tail = prompt.rstrip()
+    if tail.endswith("(0/1/2/3):"):
+        return " %d" % (h % 4)
+    if tail.endswith("Scores:"):
+        items = re.findall(r"^\[(\d+)\] (.*)$", prompt, flags=re.M)
+        return " " + " ".join("[%s] %d" % (j, _digest(ins) % 4) for j, ins in items)
+    if tail.endswith("Answers:"):
+        items = re.findall(r"^\[(\d+)\] (.*)$", prompt, flags=re.M)
+        return " " + " ".join("[%s] %s" % (j, "Yes" if _digest(q) % 2 else "No") for j, q in items)
+    if tail.endswith("Give me ID only:"):
+        return " 1"
+    if "Yes or No." in tail.split("\n")[-1]:
+        return " Yes" if h % 2 else " No"
+    if tail.endswith("data after tansformation:"):
+        match = re.search(r"data before tansformation: (.*)\n", prompt.split("The target query is")[-1])
+        return " " + (match.group(1) if match else "")
+    return " mock-%x" % (h % 0xffffff)
+
+
+LATENCY_DISTS = ("uniform", "exponential", "lognormal")
+
+
+class MockCompletionServer():
+    """Threaded completion server that injects latency and HTTP errors.
+
+    Each request sleeps for a latency drawn from `latency_dist`, then fails with
+    one of `error_codes` with probability `error_rate`. Latency distributions:
+    "uniform" is `latency` +/- `latency_jitter`, "exponential" has mean `latency`,
+    and "lognormal" has median `latency` and log-space spread `latency_sigma`;
+    the last two model the long tail of real endpoints.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        latency_dist: str = "uniform",
+        latency_sigma: float = 0.5,
+        error_rate: float = 0.0,
+        error_codes: Sequence[int] = (429, 500, 503),
+        retry_after: Optional[float] = None,
+        responder: Callable[[str], str] = mock_response,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        if latency_dist not in LATENCY_DISTS:
+            raise ValueError(f"Unknown latency distribution {latency_dist}, expected one of {LATENCY_DISTS}")
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.retry_after = retry_after
+        self.responder = responder
+        self.num_requests = 0
+        self.num_errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _sample(self):
+        """Draw (latency, error code or None) for one request."""
+        with self._lock:
+            self.num_requests += 1
+            if self.latency_dist == "exponential":
+                delay = self._rng.expovariate(1.0 / self.latency) if self.latency > 0 else 0.0
+            elif self.latency_dist == "lognormal":
+                delay = self.latency * self._rng.lognormvariate(0.0, self.latency_sigma)
+            else:
+                delay = self.latency + self._rng.uniform(-self.latency_jitter, self.latency_jitter)
+            error = None
+            if self._rng.random() < self.error_rate:
+                error = self._rng.choice(self.error_codes)
+                self.num_errors += 1
+        return max(0.0, delay), error
+
+    def _complete(self, payload: dict) -> dict:
+        prompt = payload.get("prompt", "")
+        if isinstance(prompt, list):
+            prompt = prompt[0]
+        text = self.responder(prompt)
+        for stop in payload.get("stop") or []:
+            if stop and stop in text:
+                text = text[:text.index(stop)]
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(text) // 4
+        logprobs = None
+        if payload.get("logprobs"):
+            # One pseudo token whose probability is a deterministic function of the prompt
+            logprobs = {"tokens": [text], "token_logprobs": [-((_digest(prompt) >> 8) % 1000) / 1000.0]}
+        return {
+            "id": "mock-%x" % _digest(prompt),
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+            "choices": [{"text": text, "index": 0, "logprobs": logprobs, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this, keep-alive clients stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def _send(self, status: int, body: dict, headers: Optional[dict] = None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                delay, error = server._sample()
+                time.sleep(delay)
+                if error is not None:
+                    headers = {"Retry-After": str(server.retry_after)} if server.retry_after is not None else None
+                    self._send(error, {"error": {"message": "injected error", "code": error}}, headers)
+                    return
+                self._send(200, server._complete(payload))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockCompletionServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mock completions for offline UniDM runs.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, help="Seconds per request: the mean, or the median for --latency_dist lognormal.", default=0.0)
+    parser.add_argument("--latency_jitter", type=float, help="Uniform jitter in seconds.", default=0.0)
+    parser.add_argument("--latency_dist", type=str, choices=LATENCY_DISTS, default="uniform")
+    parser.add_argument("--latency_sigma", type=float, help="Log-space spread of the lognormal latency.", default=0.5)
+    parser.add_argument("--error_rate", type=float, help="Probability of an injected error.", default=0.0)
+    parser.add_argument("--error_codes", type=int, nargs="+", default=[429, 500, 503])
+    parser.add_argument("--retry_after", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockCompletionServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        error_codes=args.error_codes,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(f"Serving mock completions at {server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+"""Response cache shared by runs, processes and datasets on one host.
+
+    python -m utils.prompt_cache stats --cache_dir prompt_cache
+    python -m utils.prompt_cache export --cache_dir prompt_cache --file warm.jsonl
+    python -m utils.prompt_cache import --cache_dir prompt_cache --file warm.jsonl
+"""
+import argparse
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .clients import Completion
+from .sqlite_store import connect, select_many
+
+
+class PromptCache():
+    """LLM responses in WAL-mode sqlite files, sharded by key prefix.
+
+    Each shard has its own file, connection and lock, so writers of different
+    shards never wait on each other, and several processes can share the cache
+    directory. Writes and LRU touches are buffered and committed `flush_every` at
+    a time. When `max_entries` is set, each shard evicts its least recently
+    used entries beyond its share of the bound at every flush.
+
+    Callers that share one cache object also share the prompts in flight: `lookup`
+    hands out each missing key to one caller, and the others wait on its `Future`
+    until the owner `fulfil`s (or `abandon`s) it.
+    """
+
+    def __init__(self, path: str, num_shards: int = 16, max_entries: int = 0, flush_every: int = 256):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_file = self.path / "meta.json"
+        # Keys must map to the same shard for the lifetime of the directory
+        if meta_file.exists():
+            num_shards = json.loads(meta_file.read_text())["num_shards"]
+        else:
+            meta_file.write_text(json.dumps({"num_shards": num_shards}))
+        self.num_shards = num_shards
+        self.shard_capacity = math.ceil(max_entries / num_shards) if max_entries > 0 else 0
+        self.flush_every = max(1, flush_every)
+
+        self._conns = [self._connect(self.path / f"shard-{i:03d}.sqlite") for i in range(num_shards)]
+        self._shard_locks = [threading.Lock() for _ in range(num_shards)]
+        self._lock = threading.Lock()
+        self._writes = [{} for _ in range(num_shards)]
+        self._touches = [{} for _ in range(num_shards)]
+        self._num_pending = 0
+        self._flight_lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _connect(path: Path) -> sqlite3.Connection:
+        return connect(path, [
+            "PRAGMA synchronous=NORMAL",
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, prompt_tokens INTEGER, "
+            "completion_tokens INTEGER, last_used REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)",
+        ])
+
+    @staticmethod
+    def key(
+        model: str,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        stop: Union[None, str, List[str]] = None,
+    ) -> str:
+        if isinstance(stop, str):
+            stop = [stop]
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "temperature": round(float(temperature), 6),
+            "max_tokens": int(max_tokens),
+            "stop": sorted(s for s in (stop or []) if s),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _shard(self, key: str) -> int:
+        return int(key[:8], 16) % self.num_shards
+
+    def get_many(self, keys: List[str]) -> Dict[str, Completion]:
+        by_shard = {}
+        for key in dict.fromkeys(keys):
+            by_shard.setdefault(self._shard(key), []).append(key)
+
+        found, now = {}, time.time()
+        for shard, shard_keys in by_shard.items():
+            with self._lock:
+                pending = self._writes[shard]
+                rows = [(k,) + pending[k][:3] for k in shard_keys if k in pending]
+            todo = [k for k in shard_keys if k not in pending]
+            with self._shard_locks[shard]:
+                query = "SELECT key, text, prompt_tokens, completion_tokens FROM responses WHERE key IN (%s)"
+                rows.extend(select_many(self._conns[shard], query, todo))
+            with self._lock:
+                for key, text, prompt_tokens, completion_tokens in rows:
+                    found[key] = Completion(text, prompt_tokens, completion_tokens, cache_hit=True)
+                    self._touches[shard][key] = now
+
+        with self._lock:
+            num_hits = sum(1 for k in keys if k in found)
+            self.hits += num_hits
+            self.misses += len(keys) - num_hits
+        return found
+
+    def lookup(self, keys: List[str]) -> Tuple[Dict[str, Completion], Dict[str, Future], List[str]]:
+        """The cached completions, the futures of keys another caller is fetching, and the keys left to this caller.
+
+        The caller must `fulfil` or `abandon` every key left to it.
+        """
+        # A fulfilled key is written before it leaves the in-flight map, so under the lock it is either cached or in flight
+        with self._flight_lock:
+            found = self.get_many(keys)
+            waiting, owned = {}, []
+            for key in dict.fromkeys(keys):
+                if key in found:
+                    continue
+                if key in self._in_flight:
+                    waiting[key] = self._in_flight[key]
+                else:
+                    self._in_flight[key] = Future()
+                    owned.append(key)
+            self.joins += len(waiting)
+        return found, waiting, owned
+
+    def fulfil(self, completions: Dict[str, Completion]):
+        """Cache the completions of keys handed out by `lookup` and wake the callers waiting on them."""
+        self.put_many(completions)
+        with self._flight_lock:
+            futures = [(self._in_flight.pop(key), c) for key, c in completions.items()]
+        for future, c in futures:
+            future.set_result(Completion(c.text, c.prompt_tokens, c.completion_tokens, cache_hit=True))
+
+    def abandon(self, keys: List[str], error: BaseException):
+        """Fail the callers waiting on keys handed out by `lookup` that could not be fetched."""
+        with self._flight_lock:
+            futures = [self._in_flight.pop(key) for key in keys if key in self._in_flight]
+        for future in futures:
+            future.set_exception(error)
+
+    def put_many(self, completions: Dict[str, Completion]):
+        now = time.time()
+        with self._lock:
+            for key, completion in completions.items():
+                shard = self._shard(key)
+                self._writes[shard][key] = (completion.text, completion.prompt_tokens, completion.completion_tokens, now)
+                self._touches[shard].pop(key, None)
+            self._num_pending += len(completions)
+            flush = self._num_pending >= self.flush_every
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            writes, self._writes = self._writes, [{} for _ in range(self.num_shards)]
+            touches, self._touches = self._touches, [{} for _ in range(self.num_shards)]
+            self._num_pending = 0
+        for shard in range(self.num_shards):
+            if writes[shard] or touches[shard]:
+                self._flush_shard(shard, writes[shard], touches[shard])
+
+    def _flush_shard(self, shard: int, writes: Dict, touches: Dict):
+        conn = self._conns[shard]
+        with self._shard_locks[shard]:
+            conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, text, prompt_tokens, completion_tokens, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(k,) + v for k, v in writes.items()],
+            )
+            conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(t, k) for k, t in touches.items()])
+            evicted = 0
+            if self.shard_capacity > 0:
+                excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.shard_capacity
+                if excess > 0:
+                    evicted = conn.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                        (excess,),
+                    ).rowcount
+            conn.commit()
+        with self._lock:
+            self.writes += len(writes)
+            self.evictions += evicted
+
+    def stats(self) -> Dict:
+        self.flush()
+        entries = 0
+        for shard, conn in enumerate(self._conns):
+            with self._shard_locks[shard]:
+                entries += conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "path": str(self.path),
+            "shards": self.num_shards,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(1, lookups),
+            # Misses answered by a request another caller already had in flight
+            "joins": self.joins,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def export(self, file: str) -> int:
+        """Write every entry as one JSON line; returns the number of entries."""
+        self.flush()
+        num = 0
+        with open(file, "w") as f:
+            for shard, conn in enumerate(self._conns):
+                with self._shard_locks[shard]:
+                    rows = conn.execute(
+                        "SELECT key, text, prompt_tokens, completion_tokens, last_used FROM responses"
+                    ).fetchall()
+                for key, text, prompt_tokens, completion_tokens, last_used in rows:
+                    record = {
+                        "key": key,
+                        "text": text,
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "last_used": last_used,
+                    }
+                    f.write(json.dumps(record) + "\n")
+                    num += 1
+        return num
+
+    def import_(self, file: str) -> int:
+        """Load entries written by `export`, keeping their recency; returns the number of entries."""
+        batches = [{} for _ in range(self.num_shards)]
+        num = 0
+        with open(file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                batches[self._shard(record["key"])][record["key"]] = (
+                    record["text"], record["prompt_tokens"], record["completion_tokens"], record["last_used"]
+                )
+                num += 1
+        for shard, writes in enumerate(batches):
+            if writes:
+                self._flush_shard(shard, writes, {})
+        return num
+
+    def close(self):
+        self.flush()
+        for shard, conn in enumerate(self._conns):
+            with self._shard_locks[shard]:
+                conn.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Inspect, export or import a prompt cache.")
+    parser.add_argument("command", choices=["stats", "export", "import"])
+    parser.add_argument("--cache_dir", type=str, default="prompt_cache")
+    parser.add_argument("--file", type=str, help="JSON-lines file to export to or import from.")
+    args = parser.parse_args(argv)
+
+    cache = PromptCache(args.cache_dir)
+    try:
+        if args.command == "stats":
+            print(json.dumps(cache.stats(), indent=2))
+        elif args.file is None:
+            parser.error(f"{args.command} needs --file")
+        elif args.command == "export":
+            print(f"Exported {cache.export(args.file)} entries to {args.file}")
+        else:
+            print(f"Imported {cache.import_(args.file)} entries into {args.cache_dir}")
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Lower-cased word tokens joined by single spaces, for exact matching."""
+    return " ".join(re.findall(r"\w+", str(text).lower()))
+
+
+def char_ngrams(text: str, n: int = 3, dim: int = 1 << 18) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash the character n-grams of `text` into `dim` buckets, returning (buckets, counts)."""
+    text = f" {text.lower()} "
+    if len(text) < n:
+        text = text.ljust(n)
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    # Polynomial rolling hash over each window; deterministic across processes unlike hash()
+    h = np.zeros(len(codes) - n + 1, dtype=np.int64)
+    for k in range(n):
+        h = (h * 1000003 + codes[k:len(codes) - n + 1 + k]) & 0x7FFFFFFF
+    return np.unique(h % dim, return_counts=True)
+
+
+class NGramIndex():
+    """TF-IDF index over hashed character n-grams, CPU only.
+
+    Rows are stored column-compressed (an inverted index of NumPy arrays), so
+    memory grows with the number of distinct n-grams per row rather than with
+    `dim`, and a query only touches the postings of its own n-grams.
+    """
+
+    def __init__(self, n: int = 3, dim: int = 1 << 18):
+        self.n = n
+        self.dim = dim
+        self.num_rows = 0
+
+    def _weigh(self, counts: np.ndarray, buckets: np.ndarray) -> np.ndarray:
+        return (1.0 + np.log(counts)) * self.idf[buckets]
+
+    def fit(self, texts: List[str]) -> "NGramIndex":
+        rows, buckets, counts = [], [], []
+        for i, text in enumerate(texts):
+            b, c = char_ngrams(text, self.n, self.dim)
+            rows.append(np.full(len(b), i, dtype=np.int64))
+            buckets.append(b)
+            counts.append(c)
+        self.num_rows = len(rows)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        buckets = np.concatenate(buckets) if buckets else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+        df = np.bincount(buckets, minlength=self.dim)
+        self.idf = np.log((1.0 + self.num_rows) / (1.0 + df)) + 1.0
+        data = self._weigh(counts, buckets)
+        norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=self.num_rows))
+        data = data / np.maximum(norms[rows], 1e-12)
+
+        order = np.argsort(buckets, kind="stable")
+        self.indices = rows[order]
+        self.data = data[order].astype(np.float32)
+        self.indptr = np.concatenate([[0], np.cumsum(df)])
+        return self
+
+    def vector(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted n-gram buckets of `text` and their unit-length TF-IDF weights."""
+        buckets, counts = char_ngrams(text, self.n, self.dim)
+        weights = self._weigh(counts, buckets)
+        return buckets, weights / max(np.sqrt((weights ** 2).sum()), 1e-12)
+
+    def similarity(self, a: str, b: str) -> float:
+        """Cosine similarity of two texts under the index's IDF weights."""
+        buckets_a, weights_a = self.vector(a)
+        buckets_b, weights_b = self.vector(b)
+        _, ia, ib = np.intersect1d(buckets_a, buckets_b, assume_unique=True, return_indices=True)
+        return float(weights_a[ia] @ weights_b[ib])
+
+    def scores(self, text: str) -> np.ndarray:
+        """Cosine similarity of `text` to every indexed row."""
+        buckets, weights = self.vector(text)
+        scores = np.zeros(self.num_rows, dtype=np.float32)
+        for b, w in zip(buckets, weights):
+            start, end = self.indptr[b], self.indptr[b + 1]
+            if start < end:
+                # Each row holds a bucket at most once, so fancy-index += is safe
+                scores[self.indices[start:end]] += w * self.data[start:end]
+        return scores
+
+    def query(self, text: str, top_m: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions and scores of the `top_m` nearest rows, best first (ties by position)."""
+        scores = self.scores(text)
+        top_m = min(top_m, self.num_rows)
+        if top_m <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, top_m - 1)[:top_m]
+        top = top[np.lexsort((top, -scores[top]))]
+        return top, scores[top]
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import hashlib
+from typing import Tuple
+
+from .sqlite_store import SqliteStore
+
+
+class ScoreStore(SqliteStore):
+    """Instance-retrieval scores keyed by content rather than by test row position.
+
+    A key hashes (target query, serialized candidate, prompt template, model), so
+    scores survive crashes, re-sampling and changes of `context_num`/`instance_num`,
+    and can never be matched to the wrong row.
+    """
+
+    table = "scores"
+    columns = ("score INTEGER NOT NULL",)
+
+    @staticmethod
+    def key(target_Q: str, instance: str, template: str, model: str) -> str:
+        payload = "\x1f".join([target_Q, instance, template, model])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def encode(self, score) -> Tuple:
+        return (int(score),)
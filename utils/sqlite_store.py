@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# Keys bound per query, well below sqlite's bound-parameter limit
+CHUNK_SIZE = 500
+
+
+def connect(path: str, statements: Iterable[str] = ()) -> sqlite3.Connection:
+    """Open a WAL-mode sqlite file that several threads and processes share, and run the schema `statements`."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in statements:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+def select_many(conn: sqlite3.Connection, query: str, keys: Sequence[str]) -> List[Tuple]:
+    """Rows of `query`, whose "%s" is filled with the placeholders of a chunk of `keys`, over all chunks."""
+    rows = []
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        rows.extend(conn.execute(query % ",".join("?" * len(chunk)), chunk).fetchall())
+    return rows
+
+
+class SqliteStore():
+    """Values keyed by a text key in one table of a shared sqlite file.
+
+    Subclasses name the `table` and its value `columns` ("name TYPE" each) and turn
+    a value into a tuple of columns and back with `encode` and `decode`. Every
+    `put_many` is committed at once.
+    """
+
+    table = None
+    columns = ()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._names = [c.split()[0] for c in self.columns]
+        self._conn = connect(path, [
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, {', '.join(self.columns)})"
+        ])
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, value) -> Tuple:
+        return (value,)
+
+    def decode(self, row: Tuple):
+        return row[0]
+
+    def get_many(self, keys: List[str]) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        query = f"SELECT key, {', '.join(self._names)} FROM {self.table} WHERE key IN (%s)"
+        with self._lock:
+            found = {row[0]: self.decode(row[1:]) for row in select_many(self._conn, query, keys)}
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, values: Dict):
+        if len(values) == 0:
+            return
+        query = (
+            f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self._names)}) "
+            f"VALUES ({', '.join('?' * (len(self._names) + 1))})"
+        )
+        with self._lock:
+            self._conn.executemany(query, [(k,) + self.encode(v) for k, v in values.items()])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
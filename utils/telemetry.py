@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import bisect
+import contextvars
+import json
+import random
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Optional
+
+import numpy as np
+
+from .constants import DEFAULT_MODEL_PRICE, MODEL_PRICES
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Which stage and test row the LLM calls of the current thread belong to
+_stage = contextvars.ContextVar("unidm_stage", default=None)
+_row = contextvars.ContextVar("unidm_row", default=None)
+
+
+@contextmanager
+def scope(stage: str, row=None):
+    """Attribute the LLM calls made inside the block to `stage` and test row `row`."""
+    stage_token, row_token = _stage.set(stage), _row.set(row)
+    try:
+        yield
+    finally:
+        _stage.reset(stage_token)
+        _row.reset(row_token)
+
+
+def current_scope():
+    return _stage.get(), _row.get()
+
+
+@lru_cache(maxsize=None)
+def _encoding(engine: str):
+    try:
+        return tiktoken.encoding_for_model(engine)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, engine: str) -> int:
+    """Tokens of `text` by the model's tokenizer if tiktoken is installed, else ~4 characters per token."""
+    if tiktoken is not None:
+        return len(_encoding(engine).encode(text))
+    return len(text) // 4
+
+
+def _new_counts() -> Dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cache_hits": 0, "retries": 0, "latency": 0.0, "cost": 0.0}
+
+
+class Histogram():
+    """Durations in fixed log-spaced buckets, so percentiles take constant memory however many are added.
+
+    Buckets run from 0.1ms to 10000s, 20 to a decade; a percentile is the geometric
+    middle of its bucket (within 6%), clamped to the smallest and largest value seen.
+    """
+
+    EDGES = list(np.logspace(-4, 4, 161))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.EDGES) + 1)
+        self.num = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_right(self.EDGES, value)] += 1
+        self.num += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        out = Histogram()
+        out.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        out.num, out.total = self.num + other.num, self.total + other.total
+        out.min, out.max = min(self.min, other.min), max(self.max, other.max)
+        return out
+
+    def percentile(self, q: float) -> float:
+        rank = q / 100 * self.num
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        # Values below the first edge or above the last are only known to be the smallest or largest seen
+        if i == 0:
+            return self.min
+        if i == len(self.EDGES):
+            return self.max
+        return float(min(max(np.sqrt(self.EDGES[i - 1] * self.EDGES[i]), self.min), self.max))
+
+    def stats(self) -> Dict:
+        if self.num == 0:
+            return {}
+        return {
+            "mean": self.total / self.num,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Telemetry():
+    """Per-call usage, latency, cache and retry records, aggregated by stage and by test row.
+
+    Token counts come from the API response when the backend reports them and
+    from `count_tokens` otherwise. Calls made outside a `scope` are filed under "other".
+    Latencies go into `Histogram`s, and a row's counts are kept only until `finish_rows`,
+    after which a reservoir of `row_sample` rows is reported, so memory stays flat
+    however many rows run.
+    """
+
+    def __init__(self, engine: str, row_sample: int = 1000):
+        self.engine = engine
+        self.prices = MODEL_PRICES.get(engine, DEFAULT_MODEL_PRICE)
+        self.stages = {}
+        # Counts of the rows still running, and a uniform sample of the finished ones
+        self.rows = {}
+        self.row_sample = row_sample
+        self.sampled_rows = []
+        self.finished_rows = 0
+        self._rng = random.Random(0)
+        self._latencies = {}
+        self._row_latency = Histogram()
+        self._row_seconds = Histogram()
+        self._lock = threading.Lock()
+
+    def record(self, prompt: str, completion, stage: Optional[str] = None, row=None):
+        prompt_tokens = completion.prompt_tokens
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(prompt, self.engine)
+        completion_tokens = completion.completion_tokens
+        if completion_tokens is None:
+            completion_tokens = count_tokens(completion.text, self.engine)
+        stage = stage or "other"
+        # Cached responses are not billed
+        cost = 0.0 if completion.cache_hit else self.cost(prompt_tokens, completion_tokens)
+
+        with self._lock:
+            targets = [self.stages.setdefault(stage, _new_counts())]
+            if row is not None:
+                targets.append(self.rows.setdefault(str(row), _new_counts()))
+            for counts in targets:
+                counts["calls"] += 1
+                counts["prompt_tokens"] += prompt_tokens
+                counts["completion_tokens"] += completion_tokens
+                counts["cache_hits"] += int(completion.cache_hit)
+                counts["retries"] += completion.retries
+                counts["latency"] += completion.latency
+                counts["cost"] += cost
+            self._latencies.setdefault(stage, Histogram()).add(completion.latency)
+
+    def record_row_seconds(self, row_seconds: Dict):
+        """Wall time of each test row through its pipeline stages, by row id."""
+        with self._lock:
+            for seconds in row_seconds.values():
+                self._row_seconds.add(seconds)
+
+    def finish_rows(self, row_ids):
+        """Fold the counts of rows that make no more calls into the row aggregates and the row sample."""
+        with self._lock:
+            for row in row_ids:
+                counts = self.rows.pop(str(row), None)
+                if counts is None:
+                    continue
+                self._row_latency.add(counts["latency"])
+                self.finished_rows += 1
+                if len(self.sampled_rows) < self.row_sample:
+                    self.sampled_rows.append((str(row), counts))
+                else:
+                    j = self._rng.randrange(self.finished_rows)
+                    if j < self.row_sample:
+                        self.sampled_rows[j] = (str(row), counts)
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens * self.prices[0] + completion_tokens * self.prices[1]) / 1000
+
+    def totals(self) -> Dict:
+        with self._lock:
+            total = _new_counts()
+            for counts in self.stages.values():
+                for k in total:
+                    total[k] += counts[k]
+        return total
+
+    def _summarize(self, counts: Dict, latencies: Optional[Histogram] = None) -> Dict:
+        out = dict(counts)
+        out["cache_misses"] = counts["calls"] - counts["cache_hits"]
+        if latencies is not None:
+            out["latency"] = dict(total=counts["latency"], **latencies.stats())
+        return out
+
+    def summary(self) -> Dict:
+        total = self.totals()
+        with self._lock:
+            stages = {s: self._summarize(c, self._latencies[s]) for s, c in self.stages.items()}
+            latencies = Histogram()
+            for histogram in self._latencies.values():
+                latencies = latencies.merge(histogram)
+            row_latency = Histogram()
+            for counts in self.rows.values():
+                row_latency.add(counts["latency"])
+            row_latency = row_latency.merge(self._row_latency)
+            rows = {r: self._summarize(c) for r, c in self.sampled_rows + list(self.rows.items())}
+            num_rows = self.finished_rows + len(self.rows)
+            row_seconds = self._row_seconds.stats()
+        return {
+            "engine": self.engine,
+            "price_per_1k_tokens": {"prompt": self.prices[0], "completion": self.prices[1]},
+            "total": self._summarize(total, latencies),
+            "stages": stages,
+            # Summed call latency per test row; calls of one row may overlap
+            "row_latency": row_latency.stats(),
+            # Wall time per test row from its first stage to its last
+            "row_seconds": row_seconds,
+            # A uniform sample of at most `row_sample` finished rows, plus the rows still running
+            "num_rows": num_rows,
+            "rows": rows,
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, default=float)
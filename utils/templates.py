@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright (C) Alibaba Group Holding Limited. All rights reserved.
+import re
+import string
+import sys
+from typing import Callable, Dict, List, Optional
+
+from .clients import Prompt
+
+# Compiled templates by name
+TEMPLATES: Dict[str, "Template"] = {}
+# "[id] value" items of the reply to a batched prompt
+INDEXED_ITEM = re.compile(r"\[(\d+)\]\s*:?\s*(\w+)")
+INDEXED_REPLY = re.compile(r"\s*(?:\[\d+\]\s*:?\s*\w+[\s,;.]*)+")
+
+
+class PromptRef(tuple):
+    """A prompt kept as (template name, slot values) and rendered only when its text is needed."""
+
+    __slots__ = ()
+
+    def __new__(cls, name: str, values: tuple):
+        return tuple.__new__(cls, (name, values))
+
+    def render(self) -> str:
+        return TEMPLATES[self[0]].render_values(self[1])
+
+
+class Template():
+    """A prompt template compiled once into interned constant segments and named slots.
+
+    `text` marks slots as `str.format` fields, e.g. "The target is {target}\\n"; a
+    slot may appear more than once. `render` fills the slots with one join, and
+    `ref` keeps the slot values to render later. With `prefix`, the text up to and
+    including that slot is the shared prefix of the rendered `Prompt`.
+    """
+
+    def __init__(self, name: str, text: str, prefix: Optional[str] = None):
+        self.name = sys.intern(name)
+        self.text = text
+        self.parts, self.fields, self.slots = [], [], []
+        self.prefix_end = None
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                self.parts.append(sys.intern(literal))
+            if field is None:
+                continue
+            if spec or conversion:
+                raise ValueError(f"Template {name}: slot {field} cannot have a format spec or conversion")
+            if field not in self.fields:
+                self.fields.append(field)
+            self.slots.append((len(self.parts), self.fields.index(field)))
+            self.parts.append(None)
+            if field == prefix and self.prefix_end is None:
+                self.prefix_end = len(self.parts)
+        if prefix is not None and self.prefix_end is None:
+            raise ValueError(f"Template {name} has no prefix slot {prefix}")
+        TEMPLATES[self.name] = self
+
+    def values(self, params: Dict[str, str]) -> tuple:
+        return tuple(params[f] for f in self.fields)
+
+    def render_values(self, values: tuple) -> str:
+        parts = list(self.parts)
+        for position, field in self.slots:
+            parts[position] = values[field]
+        if self.prefix_end is None:
+            return "".join(parts)
+        return Prompt.join("".join(parts[:self.prefix_end]), "".join(parts[self.prefix_end:]))
+
+    def render(self, **params) -> str:
+        return self.render_values(self.values(params))
+
+    def ref(self, **params) -> PromptRef:
+        return PromptRef(self.name, self.values(params))
+
+
+def expand(prompt):
+    """The text of a prompt that may be kept as a `PromptRef`."""
+    return prompt.render() if isinstance(prompt, PromptRef) else prompt
+
+
+def parse_indexed_reply(gen_text: str, num: int, check: Callable[[str], Optional[object]]) -> List:
+    """Strictly parse a "[1] a [2] b ..." reply into `num` values, `check` turning an item into its value or None.
+
+    The first line must be nothing but "[id] value" items, otherwise no item is
+    trusted. Items that are missing, rejected by `check` or given twice come back as None.
+    """
+    line = list(filter(None, gen_text.split('\n')))
+    line = line[0] if line else ""
+    if INDEXED_REPLY.fullmatch(line) is None:
+        return [None] * num
+    found = {}
+    for idx, value in INDEXED_ITEM.findall(line):
+        idx = int(idx)
+        found[idx] = None if idx in found else check(value)
+    return [found.get(j + 1) for j in range(num)]
@@ -2,13 +2,16 @@
 # Copyright (C) Alibaba Group Holding Limited. All rights reserved.
 import logging
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-from rich.logging import RichHandler
+import numpy as np
+import pandas as pd
 
 
 def setup_logger(log_dir: str):
     """Create log directory and logger."""
+    from rich.logging import RichHandler
+
     Path(log_dir).mkdir(exist_ok=True, parents=True)
     log_path = str(Path(log_dir) / "log.txt")
     handlers = [logging.FileHandler(log_path), RichHandler(rich_tracebacks=True)]
@@ -16,45 +19,100 @@ def setup_logger(log_dir: str):
         level=logging.INFO,
         format="%(asctime)s [%(module)s] [%(levelname)s] %(message)s",
         handlers=handlers,
+        # A process may run several configurations in turn, each logging to its own directory
+        force=True,
     )
 
 
-def compute_metrics(preds: List, golds: List, task: str):
-    """Compute metrics."""
-    mets = {"tp": 0, "tn": 0, "fp": 0, "fn": 0, "crc": 0, "total": 0}
-    for pred, label in zip(preds, golds):
-        label = label.strip().lower()
-        pred = pred.strip().lower()
-        mets["total"] += 1
-        if task in {"data_imputation"} or task in {"data_transformation"}:
-            crc = pred == label
-        elif task in {"entity_resolution"}:
-            pred = "yes" if "yes" in pred else "no"
-            crc = pred == label
-        elif task in {"entity_resolution", "schema_matching", "error_detection_spelling"}:
-            crc = pred.startswith(label)
-        elif task in {"error_detection"}:
-            pred = pred.split("\n\n")[-1]
-            # breakpoint()
-            crc = pred.endswith(label)
-        else:
-            raise ValueError(f"Unknown task: {task}")
-        # Measure equal accuracy for generation
-        if crc:
-            mets["crc"] += 1
-        if label == "yes":
-            if crc:
-                mets["tp"] += 1
-            else:
-                mets["fn"] += 1
-        elif label == "no":
-            if crc:
-                mets["tn"] += 1
-            else:
-                mets["fp"] += 1
+def correct(preds: List, golds: List, task: str) -> np.ndarray:
+    """Whether each prediction counts as correct for its label, with vectorized string ops."""
+    pred = pd.Series(list(preds), dtype=object).astype(str).str.strip().str.lower()
+    label = pd.Series(list(golds), dtype=object).astype(str).str.strip().str.lower()
+    if task in {"data_imputation"} or task in {"data_transformation"}:
+        return (pred == label).to_numpy(dtype=bool)
+    elif task in {"entity_resolution"}:
+        pred = np.where(pred.str.contains("yes", regex=False), "yes", "no")
+        return pred == label.to_numpy(dtype=str)
+    elif task in {"schema_matching", "error_detection_spelling"}:
+        return np.char.startswith(pred.to_numpy(dtype=str), label.to_numpy(dtype=str))
+    elif task in {"error_detection"}:
+        pred = pred.str.split("\n\n").str[-1]
+        return np.char.endswith(pred.to_numpy(dtype=str), label.to_numpy(dtype=str))
+    raise ValueError(f"Unknown task: {task}")
+
 
+def count_metrics(preds: List, golds: List, task: str, mets: Dict = None):
+    """Accumulate confusion counts, e.g. over the chunks of a streamed test set."""
+    if mets is None:
+        mets = {"tp": 0, "tn": 0, "fp": 0, "fn": 0, "crc": 0, "total": 0}
+    crc = correct(preds, golds, task)
+    label = pd.Series(list(golds), dtype=object).astype(str).str.strip().str.lower()
+    # Measure equal accuracy for generation
+    yes, no = (label == "yes").to_numpy(dtype=bool), (label == "no").to_numpy(dtype=bool)
+    mets["total"] += len(crc)
+    mets["crc"] += int(crc.sum())
+    mets["tp"] += int((crc & yes).sum())
+    mets["fn"] += int((~crc & yes).sum())
+    mets["tn"] += int((crc & no).sum())
+    mets["fp"] += int((~crc & no).sum())
+    return mets
+
+
+def metrics_from_counts(mets: Dict):
+    """Turn confusion counts into (precision, recall, accuracy, f1)."""
     prec = mets["tp"] / max(1, (mets["tp"] + mets["fp"]))
     rec = mets["tp"] / max(1, (mets["tp"] + mets["fn"]))
-    acc = mets["crc"] / mets["total"]
+    acc = mets["crc"] / max(1, mets["total"])
     f1 = 2 * prec * rec / max(1, (prec + rec))
     return prec, rec, acc, f1
+
+
+def compute_metrics(preds: List, golds: List, task: str):
+    """Compute metrics."""
+    return metrics_from_counts(count_metrics(preds, golds, task))
+
+
+METRIC_NAMES = ("prec", "rec", "acc", "f1")
+
+
+def _metrics_from_count_arrays(counts: np.ndarray) -> np.ndarray:
+    """`metrics_from_counts` over rows of (tp, fn, tn, fp, other correct, other wrong) counts."""
+    tp, fn, tn, fp, other_crc, other_wrong = counts.T
+    prec = tp / np.maximum(1, tp + fp)
+    rec = tp / np.maximum(1, tp + fn)
+    acc = (tp + tn + other_crc) / np.maximum(1, counts.sum(axis=1))
+    f1 = 2 * prec * rec / np.maximum(1, prec + rec)
+    return np.stack([prec, rec, acc, f1], axis=1)
+
+
+def summarize_trials(trial_counts: List[Dict], num_resamples: int = 1000, alpha: float = 0.05, seed: int = 0) -> Dict:
+    """Mean and std over trials of each metric, with a bootstrap confidence interval of the mean.
+
+    Resampling the test rows with replacement only changes how many rows fall in
+    each confusion cell, so each trial's resamples are drawn as multinomial cell
+    counts rather than by materializing resampled rows.
+    """
+    rng = np.random.RandomState(seed)
+    values, resampled = [], []
+    for mets in trial_counts:
+        other_crc = mets["crc"] - mets["tp"] - mets["tn"]
+        other_wrong = mets["total"] - mets["tp"] - mets["fn"] - mets["tn"] - mets["fp"] - other_crc
+        cells = np.array([mets["tp"], mets["fn"], mets["tn"], mets["fp"], other_crc, other_wrong], dtype=np.float64)
+        values.append(metrics_from_counts(mets))
+        if mets["total"] > 0:
+            counts = rng.multinomial(mets["total"], cells / mets["total"], size=num_resamples)
+        else:
+            counts = np.zeros((num_resamples, len(cells)))
+        resampled.append(_metrics_from_count_arrays(counts))
+    values = np.array(values, dtype=np.float64).reshape(-1, len(METRIC_NAMES))
+    # Each resample pairs one bootstrap draw of every trial, so the interval is for the mean over trials
+    means = np.mean(resampled, axis=0)
+    lower, upper = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return {
+        name: {
+            "mean": float(values[:, j].mean()),
+            "std": float(values[:, j].std(ddof=1)) if len(values) > 1 else 0.0,
+            "ci": [float(lower[j]), float(upper[j])],
+        }
+        for j, name in enumerate(METRIC_NAMES)
+    }